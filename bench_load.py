@@ -0,0 +1,345 @@
+"""Load test of the hub's ingest and query paths, with results saved as JSON.
+
+    python bench_load.py
+    python bench_load.py --sizes 0,100000,1000000 --conversations 1000,10000
+    python bench_load.py --url http://127.0.0.1:9000 --sizes 0,100000
+    python bench_load.py --compare bench_results/load-<old>.json
+
+For every store size and conversation count the store is first filled through
+/webhook/n8n/batch. The measured phase then runs for --duration seconds:
+- n8n-style bursts of concurrent POST /webhook/n8n requests
+- --pollers consoles, each polling /messages/by-phone with its cursor every
+  REFRESH_INTERVAL_MS, like streamlit9.py / streamlit10.py
+
+Throughput, p50/p99 latency and memory growth are reported per scenario.
+
+By default the app in main.py is driven in-process (httpx ASGITransport), so
+client and server share one event loop. Each scenario starts from an empty
+store, and process RSS is reported. With --url a running hub is driven over
+HTTP. Its store cannot be reset, so sizes must be ascending and only the
+difference is added. Memory then comes from the hub's /stats estimate.
+
+All traffic comes from one tenant, so in-process runs turn the per-tenant
+rate limit off (HUB_TENANT_RATE=0). A running hub may answer 429: the prefill
+waits for Retry-After, and during the load phase 429s count as errors.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+# Same cadence as the consoles' st_autorefresh
+REFRESH_INTERVAL_MS = 2000
+TENANT_PHONE = "+16148193454"
+PREFILL_BATCH = 5000
+
+
+def phone(conversation: int) -> str:
+    return f"+1555{conversation:07d}"
+
+
+def make_msg(conversation: int, n: int) -> dict:
+    # Distinct text and timestamp per message, so nothing is collapsed as a retry
+    return {
+        "chatId": f"chat-{conversation}",
+        "tenantPhone": TENANT_PHONE,
+        "patientPhone": phone(conversation),
+        "message": f"load message {n}",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def rss_bytes():
+    # Current resident set size of this process (Linux), else the peak
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    result = {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": None,
+        "p99_ms": None,
+        "max_ms": None,
+    }
+    if len(latencies) >= 2:
+        cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+        result.update(p50_ms=round(cuts[49] * 1e3, 3), p99_ms=round(cuts[98] * 1e3, 3))
+    if latencies:
+        result["max_ms"] = round(max(latencies) * 1e3, 3)
+    return result
+
+
+class Load:
+    def __init__(self, client: httpx.AsyncClient, args):
+        self.client = client
+        self.args = args
+        self.sent = 0
+
+    async def prefill(self, messages: int, conversations: int) -> dict:
+        started = time.perf_counter()
+        remaining = messages
+        while remaining > 0:
+            count = min(PREFILL_BATCH, remaining)
+            batch = [make_msg((self.sent + i) % conversations, self.sent + i) for i in range(count)]
+            resp = await self.client.post("/webhook/n8n/batch", json=batch)
+            if resp.status_code == 429:
+                await asyncio.sleep(float(resp.headers.get("retry-after", "1")))
+                continue
+            resp.raise_for_status()
+            self.sent += count
+            remaining -= count
+        elapsed = time.perf_counter() - started
+        return {
+            "messages": messages,
+            "seconds": round(elapsed, 3),
+            "throughput": round(messages / elapsed, 1) if messages else 0.0,
+        }
+
+    async def bursts(self, conversations: int, deadline: float, latencies: list) -> int:
+        errors = 0
+
+        async def post(msg):
+            nonlocal errors
+            t0 = time.perf_counter()
+            try:
+                resp = await self.client.post("/webhook/n8n", json=msg)
+                resp.raise_for_status()
+            except httpx.HTTPError:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - t0)
+
+        # The burst targets the polled conversations, so pollers see fresh deltas
+        targets = min(conversations, self.args.pollers) or 1
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            msgs = []
+            for _ in range(self.args.burst_size):
+                msgs.append(make_msg(self.sent % targets, self.sent))
+                self.sent += 1
+            await asyncio.gather(*(post(m) for m in msgs))
+            await asyncio.sleep(max(0.0, self.args.burst_interval - (time.perf_counter() - started)))
+        return errors
+
+    async def poller(self, conversation: int, deadline: float, latencies: list, offset: float) -> int:
+        errors = 0
+        cursor = 0
+        interval = self.args.poll_interval_ms / 1000
+        # Consoles are not in lockstep: spread the first poll over one interval
+        await asyncio.sleep(offset)
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                resp = await self.client.get(
+                    "/messages/by-phone",
+                    params={"patientPhone": phone(conversation), "since": cursor, "limit": self.args.page_limit},
+                )
+                resp.raise_for_status()
+                cursor = resp.json().get("nextCursor", cursor)
+            except httpx.HTTPError:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(max(0.0, interval - (time.perf_counter() - started)))
+        return errors
+
+    async def run(self, conversations: int) -> dict:
+        ingest_lat: list = []
+        poll_lat: list = []
+        started = time.perf_counter()
+        deadline = started + self.args.duration
+        interval = self.args.poll_interval_ms / 1000
+        pollers = [
+            self.poller(c % conversations, deadline, poll_lat, interval * c / self.args.pollers)
+            for c in range(self.args.pollers)
+        ]
+        errors = await asyncio.gather(self.bursts(conversations, deadline, ingest_lat), *pollers)
+        elapsed = time.perf_counter() - started
+        return {
+            "ingest": summarize(ingest_lat, errors[0], elapsed),
+            "poll": summarize(poll_lat, sum(errors[1:]), elapsed),
+        }
+
+    async def store_stats(self) -> dict:
+        resp = await self.client.get("/stats")
+        resp.raise_for_status()
+        return resp.json()["store"]
+
+
+async def scenario(client: httpx.AsyncClient, args, size: int, conversations: int, prefilled: int) -> dict:
+    load = Load(client, args)
+    rss_start = rss_bytes() if not args.url else None
+    prefill = await load.prefill(size - prefilled, conversations)
+    before = await load.store_stats()
+    rss_prefilled = rss_bytes() if not args.url else None
+    measured = await load.run(conversations)
+    after = await load.store_stats()
+    rss_end = rss_bytes() if not args.url else None
+    result = {
+        "size": size,
+        "conversations": conversations,
+        "prefill": prefill,
+        **measured,
+        "memory": {
+            "store_bytes_prefilled": before["bytes"],
+            "store_bytes_end": after["bytes"],
+            "store_messages_end": after["messages"],
+            "rss_start": rss_start,
+            "rss_prefilled": rss_prefilled,
+            "rss_end": rss_end,
+        },
+    }
+    if rss_start is not None:
+        per_msg = (rss_prefilled - rss_start) / size if size else None
+        result["memory"]["rss_bytes_per_message"] = round(per_msg, 1) if per_msg is not None else None
+    return result
+
+
+def git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_row(r: dict) -> None:
+    ing, poll, mem = r["ingest"], r["poll"], r["memory"]
+    rss = f"{mem['rss_end'] / 2**20:.0f}" if mem["rss_end"] else "-"
+    print(
+        f"{r['size']:>9} {r['conversations']:>7} {r['prefill']['throughput']:>10.0f}"
+        f" {ing['throughput']:>8.0f} {ing['p50_ms'] or 0:>8.2f} {ing['p99_ms'] or 0:>8.2f}"
+        f" {poll['throughput']:>8.0f} {poll['p50_ms'] or 0:>8.2f} {poll['p99_ms'] or 0:>8.2f}"
+        f" {mem['store_bytes_end'] / 2**20:>9.1f} {rss:>8}"
+        f" {ing['errors'] + poll['errors']:>6}"
+    )
+
+
+def compare(old: dict, new: dict) -> None:
+    # Ratios new/old per scenario: throughput below 1 or p99 above 1 is a regression
+    previous = {(r["size"], r["conversations"]): r for r in old["scenarios"]}
+    print(f"\ncompared with {old['meta'].get('commit') or '?'} ({old['meta']['started']})")
+    print(f"{'messages':>9} {'convs':>7} {'ingest/s':>9} {'ingest p99':>11} {'poll/s':>8} {'poll p99':>9}")
+
+    def ratio(a, b):
+        return f"{a / b:.2f}x" if a and b else "-"
+
+    for r in new["scenarios"]:
+        o = previous.get((r["size"], r["conversations"]))
+        if o is None:
+            continue
+        print(
+            f"{r['size']:>9} {r['conversations']:>7}"
+            f" {ratio(r['ingest']['throughput'], o['ingest']['throughput']):>9}"
+            f" {ratio(r['ingest']['p99_ms'], o['ingest']['p99_ms']):>11}"
+            f" {ratio(r['poll']['throughput'], o['poll']['throughput']):>8}"
+            f" {ratio(r['poll']['p99_ms'], o['poll']['p99_ms']):>9}"
+        )
+
+
+async def run(args) -> dict:
+    sizes = [int(s) for s in args.sizes.split(",")]
+    conversation_counts = [int(c) for c in args.conversations.split(",")]
+    results = []
+    print(
+        f"{'messages':>9} {'convs':>7} {'prefill/s':>10} {'ingest/s':>8} {'p50 ms':>8} {'p99 ms':>8}"
+        f" {'poll/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'store MB':>9} {'rss MB':>8} {'errors':>6}"
+    )
+    limits = httpx.Limits(max_connections=args.pollers + args.burst_size, max_keepalive_connections=args.pollers + args.burst_size)
+
+    if args.url:
+        if sizes != sorted(sizes):
+            raise SystemExit("--sizes must be ascending with --url (the hub's store cannot be reset)")
+        async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=30) as client:
+            prefilled = (await Load(client, args).store_stats())["messages"]
+            for conversations in conversation_counts:
+                for size in sizes:
+                    size = max(size, prefilled)
+                    results.append(await scenario(client, args, size, conversations, prefilled))
+                    prefilled = results[-1]["memory"]["store_messages_end"]
+                    print_row(results[-1])
+        return results
+
+    # Quiet the per-request log lines and keep everything in memory
+    os.environ.setdefault("HUB_LOG_LEVEL", "WARNING")
+    os.environ["HUB_STORAGE"] = "memory"
+    os.environ.setdefault("HUB_TENANT_RATE", "0")
+    import gc
+    import main
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://hub", timeout=30) as client:
+        for conversations in conversation_counts:
+            for size in sizes:
+                main.reset_state()
+                gc.collect()
+                results.append(await scenario(client, args, size, conversations, 0))
+                print_row(results[-1])
+    main.reset_state()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="drive a running hub instead of main.app in-process")
+    parser.add_argument("--sizes", default="0,100000,500000", help="messages in the store before the load phase")
+    parser.add_argument("--conversations", default="1000,10000", help="conversations the store is spread over")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load per scenario")
+    parser.add_argument("--pollers", type=int, default=200, help="consoles polling /messages/by-phone")
+    parser.add_argument("--poll-interval-ms", type=int, default=REFRESH_INTERVAL_MS)
+    parser.add_argument("--page-limit", type=int, default=200, help="limit sent with each poll")
+    parser.add_argument("--burst-size", type=int, default=50, help="concurrent webhook posts per burst")
+    parser.add_argument("--burst-interval", type=float, default=0.5, help="seconds between burst starts (0: back to back)")
+    parser.add_argument("--out", help="result file (default bench_results/load-<commit>-<time>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    args = parser.parse_args()
+
+    started = datetime.now(timezone.utc)
+    commit = git_commit()
+    scenarios = asyncio.run(run(args))
+    report = {
+        "meta": {
+            "started": started.isoformat(),
+            "commit": commit,
+            "mode": "url" if args.url else "in-process",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "scenarios": scenarios,
+    }
+
+    out = args.out or os.path.join(
+        "bench_results", f"load-{commit or 'nogit'}-{started.strftime('%Y%m%dT%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nsaved {out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Latency of /messages/search queries against the hub's full-text index as the store grows.
+
+    python bench_search.py
+    python bench_search.py --sizes 100000,1000000,3000000
+
+Every size is filled with messages drawn from a Zipf-like vocabulary spread
+over many conversations. `scan` is a substring scan over every message, for
+comparison; the index columns should stay in the (sub)millisecond range.
+"""
+import argparse
+import gc
+import random
+import statistics
+import time
+
+from main import MessageStore
+
+TENANT_PHONES = ["+16148193454", "+16148190000", "+16148191111"]
+COMMON = ["hi", "thanks", "appointment", "today", "please", "refill", "pharmacy", "call", "tomorrow", "ok"]
+QUERIES = [
+    ("rare term", "w1234", {}),
+    ("common term", "appointment", {}),
+    ("two terms", "refill pharmacy", {}),
+    ("prefix", "pharm*", {}),
+    ("term + phone", "appointment", {"patient_phone": "+15550000042"}),
+    ("term + tenant", "refill", {"tenant_phone": TENANT_PHONES[1]}),
+]
+
+
+def make_msg(rng: random.Random, i: int, conversations: int, vocab: list) -> dict:
+    words = [rng.choice(COMMON) if rng.random() < 0.3 else vocab[int(rng.paretovariate(1.1)) % len(vocab)]
+             for _ in range(10)]
+    phone = f"+1555{i % conversations:07d}"
+    return {
+        "chatId": f"chat-{phone}",
+        "tenantPhone": TENANT_PHONES[i % conversations % len(TENANT_PHONES)],
+        "patientPhone": phone,
+        "message": " ".join(words),
+        "timestamp": None,
+        "receivedAt": "2024-01-01T00:00:00",
+    }
+
+
+def time_query(fn, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="100000,1000000")
+    parser.add_argument("--conversations", type=int, default=10000)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--scan-limit", type=int, default=1000000, help="skip the substring scan above this size")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    vocab = [f"w{i}" for i in range(args.vocabulary)]
+    for size in (int(s) for s in args.sizes.split(",")):
+        gc.collect()
+        store = MessageStore(max_per_conversation=0, ttl_s=0, max_messages=0, max_bytes=0)
+        t0 = time.perf_counter()
+        for i in range(size):
+            store.add(make_msg(rng, i, args.conversations, vocab))
+        ingest_rate = size / (time.perf_counter() - t0)
+        index = store.index.stats()
+        print(
+            f"{size} messages: {ingest_rate:.0f} msg/s ingest, index {index['terms']} terms, "
+            f"{index['postings']} postings, ~{index['bytes'] / 2**20:.0f} MiB"
+        )
+        print(f"  {'query':<16} {'index ms':>10} {'scan ms':>10} {'hits':>6}")
+        for name, query, filters in QUERIES:
+            hits = len(store.search(query, limit=args.limit, **filters)[0])
+            indexed = time_query(lambda: store.search(query, limit=args.limit, **filters), args.repeat)
+            scan = "-"
+            if size <= args.scan_limit:
+                needle = query.split()[0].rstrip("*")
+                scan_s = time_query(
+                    lambda: [m for c in store._convs.values() for m in c.messages if needle in m["message"]], 3
+                )
+                scan = f"{scan_s * 1e3:.1f}"
+            print(f"  {name:<16} {indexed * 1e3:>10.3f} {scan:>10} {hits:>6}")
+        del store
+
+
+if __name__ == "__main__":
+    main()
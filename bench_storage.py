@@ -0,0 +1,66 @@
+"""Ingest throughput and cold-start replay time of the durable storage backend.
+
+    python bench_storage.py
+    python bench_storage.py --messages 1000000 --path /tmp/hub-bench.db
+
+Ingest is measured up to the point where every message is committed, and is
+compared with the in-memory path alone. Cold start is a fresh MessageStore
+rebuilt from the database, as load_messages() does at startup.
+"""
+import argparse
+import os
+import time
+
+from bench_store import make_msg
+from main import MessageStore
+from storage import SQLiteBackend
+
+
+def unbounded_store() -> MessageStore:
+    return MessageStore(max_per_conversation=0, ttl_s=0, max_messages=0, max_bytes=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--conversations", type=int, default=10000)
+    parser.add_argument("--path", default="bench_storage.db")
+    parser.add_argument("--synchronous", default="NORMAL")
+    args = parser.parse_args()
+    phones = [f"+1555{c:07d}" for c in range(args.conversations)]
+
+    store = unbounded_store()
+    t0 = time.perf_counter()
+    for i in range(args.messages):
+        store.add(make_msg(phones[i % args.conversations]))
+    memory_s = time.perf_counter() - t0
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(args.path + suffix):
+            os.remove(args.path + suffix)
+    store = unbounded_store()
+    backend = SQLiteBackend(args.path, synchronous=args.synchronous)
+    t0 = time.perf_counter()
+    for i in range(args.messages):
+        msg = make_msg(phones[i % args.conversations])
+        received = time.time()
+        store.add(msg, received)
+        backend.append([(msg, received)])
+    backend.close()
+    sqlite_s = time.perf_counter() - t0
+
+    backend = SQLiteBackend(args.path, synchronous=args.synchronous)
+    store = unbounded_store()
+    t0 = time.perf_counter()
+    store.load(backend.replay())
+    replay_s = time.perf_counter() - t0
+    backend.close()
+
+    print(f"messages          {args.messages}")
+    print(f"memory ingest/s   {args.messages / memory_s:.0f}")
+    print(f"sqlite ingest/s   {args.messages / sqlite_s:.0f}  ({sqlite_s / memory_s:.2f}x slower)")
+    print(f"cold start        {replay_s:.2f}s  ({len(store)} messages, lastSeq {store.last_seq})")
+
+
+if __name__ == "__main__":
+    main()
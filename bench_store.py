@@ -0,0 +1,87 @@
+"""Lookup latency of the hub's message store as the number of stored messages grows.
+
+    python bench_store.py
+    python bench_store.py --sizes 10000,100000,1000000,10000000
+
+Every size is filled with background traffic spread over many conversations,
+plus one watched conversation of fixed length. A flat `indexed` column means a
+`/messages/by-phone` lookup costs the same no matter how much else is stored;
+`scan` is the old list-comprehension over every message, for comparison.
+"""
+import argparse
+import gc
+import statistics
+import time
+
+from main import MessageStore
+
+WATCHED_PHONE = "+15550000000"
+TENANT_PHONE = "+16148193454"
+
+
+def make_msg(patient_phone: str) -> dict:
+    return {
+        "chatId": f"chat-{patient_phone}",
+        "tenantPhone": TENANT_PHONE,
+        "patientPhone": patient_phone,
+        "message": "hello",
+        "timestamp": None,
+        "receivedAt": "2024-01-01T00:00:00",
+    }
+
+
+def fill(size: int, conversations: int, watched_len: int) -> tuple:
+    store = MessageStore(max_per_conversation=0, ttl_s=0, max_messages=0, max_bytes=0)
+    flat = []
+    phones = [f"+1555{c:07d}" for c in range(1, conversations + 1)]
+    every = max(1, size // watched_len)
+    for i in range(size):
+        if i % every == 0 and i // every < watched_len:
+            phone = WATCHED_PHONE
+        else:
+            phone = phones[i % conversations]
+        msg = make_msg(phone)
+        store.add(msg)
+        flat.append(msg)
+    return store, flat
+
+
+def time_lookup(fn, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--conversations", type=int, default=10000)
+    parser.add_argument("--watched", type=int, default=50, help="messages in the watched conversation")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--scan-limit", type=int, default=1000000, help="skip the linear scan above this size")
+    args = parser.parse_args()
+
+    print(f"{'messages':>12} {'ingest/s':>12} {'indexed us':>12} {'scan us':>12}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        gc.collect()
+        t0 = time.perf_counter()
+        store, flat = fill(size, args.conversations, args.watched)
+        ingest_rate = size / (time.perf_counter() - t0)
+
+        indexed = time_lookup(lambda: store.by_patient(WATCHED_PHONE), args.repeat)
+        scan = "-"
+        if size <= args.scan_limit:
+            scan_s = time_lookup(
+                lambda: [m for m in flat if m["patientPhone"] == WATCHED_PHONE],
+                max(3, args.repeat // 50),
+            )
+            scan = f"{scan_s * 1e6:.1f}"
+        print(f"{size:>12} {ingest_rate:>12.0f} {indexed * 1e6:>12.2f} {scan:>12}")
+        del store, flat
+
+
+if __name__ == "__main__":
+    main()
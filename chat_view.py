@@ -0,0 +1,86 @@
+import os
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import streamlit as st
+import streamlit.components.v1 as components
+
+# Chat view shared by the consoles: a custom component (chat_component/)
+# whose iframe stays mounted across reruns. Instead of rebuilding the whole
+# conversation as HTML on every tick, each rerun ships only the messages that
+# were added or changed since the previous one; the browser keeps the rest
+# and only renders the rows near the visible range.
+#
+# The component value carries the latest request of each kind ("resync",
+# "older") as a timestamp token; a request is new when its token differs from
+# the one last handled, recorded in st.session_state[f"{key}_sync"].
+
+_component = components.declare_component(
+    "chat_view", path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_component")
+)
+
+
+def chat_item(msg: Dict[str, Any], role: str) -> Dict[str, Any]:
+    return {
+        "id": msg["id"],
+        "ts": msg.get("createdAt") or "",
+        "t": msg.get("epoch"),
+        "role": role,
+        "text": msg.get("message") or "",
+        "status": msg.get("status") or "",
+    }
+
+
+def _sync(key: str) -> Dict[str, Any]:
+    return st.session_state.setdefault(f"{key}_sync", {"version": 0, "resync": 0, "older": 0})
+
+
+def _new_request(key: str, kind: str) -> bool:
+    sync = _sync(key)
+    request = st.session_state.get(key)
+    if isinstance(request, dict) and request.get(kind, 0) != sync.get(kind, 0):
+        sync[kind] = request[kind]
+        return True
+    return False
+
+
+def older_requested(key: str = "chat") -> bool:
+    # True once per scroll to the top of a view rendered with has_older=True.
+    # Call it before loading (and before chat_view) so the page ships in this run.
+    return _new_request(key, "older")
+
+
+def chat_view(
+    messages: Iterable[Dict[str, Any]],
+    changed: List[Dict[str, Any]],
+    role_of: Callable[[Dict[str, Any]], str],
+    reset: bool = False,
+    height: int = 520,
+    stream_url: Optional[str] = None,
+    has_older: bool = False,
+    key: str = "chat",
+):
+    # `changed` holds the messages appended or updated since the previous call
+    # (upserted by id). The full `messages` list is only sent with reset=True
+    # (new conversation) or when the component asks for it: it tracks the
+    # version it has applied and requests a resync when it sees a gap, e.g.
+    # after being remounted. `has_older` lets scrolling to the top request
+    # older history (see older_requested()).
+    sync = _sync(key)
+    if _new_request(key, "resync"):
+        reset = True
+
+    base = sync["version"]
+    payload = messages if reset else changed
+    if reset or payload:
+        sync["version"] += 1
+    _component(
+        messages=[chat_item(m, role_of(m)) for m in payload],
+        base=base,
+        version=sync["version"],
+        reset=reset,
+        height=height,
+        streamUrl=stream_url,
+        hasOlder=has_older,
+        key=key,
+        default=None,
+    )
@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from urllib3.util.retry import Retry
+
+# HTTP client shared by the Streamlit consoles. One instance is kept per
+# server process (st.cache_resource), so every rerun of every browser tab
+# reuses the same keep-alive connections to REALTIME_HUB and API_BASE instead
+# of opening a new TCP connection per request.
+
+CONNECT_TIMEOUT = 3.05
+TIMING_SAMPLES = 512
+
+
+def failed_before_sending(exc: Exception) -> bool:
+    # True if no connection could be made (refused, unresolvable, connect
+    # timeout), i.e. the request never reached the server and sending it again
+    # cannot deliver it twice. A connection dropped later (RemoteDisconnected,
+    # ChunkedEncodingError, read timeout) may come after the server took it.
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(exc, requests.exceptions.ConnectionError) or not exc.args:
+        return False
+    # requests wraps urllib3's MaxRetryError, whose reason is the cause
+    reason = getattr(exc.args[0], "reason", exc.args[0])
+    # NewConnectionError (and NameResolutionError) subclass ConnectTimeoutError
+    return isinstance(reason, ConnectTimeoutError)
+
+
+class EndpointTimings:
+    # Latency samples per endpoint name, bounded; shared by all script threads
+    def __init__(self, samples: int = TIMING_SAMPLES):
+        self._samples = samples
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, deque] = {}
+        self._counts: Dict[str, list] = {}
+
+    def record(self, endpoint: str, seconds: float, ok: bool) -> None:
+        with self._lock:
+            latencies = self._latencies.get(endpoint)
+            if latencies is None:
+                latencies = self._latencies[endpoint] = deque(maxlen=self._samples)
+                self._counts[endpoint] = [0, 0]
+            latencies.append(seconds)
+            counts = self._counts[endpoint]
+            counts[0] += 1
+            if not ok:
+                counts[1] += 1
+
+    def summary(self) -> Dict[str, dict]:
+        # Percentiles are over the most recent samples, counts over the process lifetime
+        with self._lock:
+            snapshot = {name: (sorted(lat), tuple(self._counts[name])) for name, lat in self._latencies.items()}
+        out = {}
+        for name, (lat, (calls, errors)) in snapshot.items():
+            out[name] = {
+                "calls": calls,
+                "errors": errors,
+                "p50_ms": round(lat[len(lat) // 2] * 1e3, 1),
+                "p99_ms": round(lat[min(len(lat) - 1, int(len(lat) * 0.99))] * 1e3, 1),
+                "max_ms": round(lat[-1] * 1e3, 1),
+            }
+        return out
+
+
+class ConsoleClient:
+    # requests.Session with a sized connection pool and retries with
+    # exponential backoff. GETs are retried on connection errors, read errors
+    # and 502/503/504; POSTs only when the connection could not be made, so
+    # a send is never delivered twice.
+    def __init__(self, pool_size: int = 32, retries: int = 3, backoff: float = 0.2):
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False,
+        )
+        # One pool per host (hub and API); pool_maxsize bounds the idle
+        # keep-alive connections per host, roughly the concurrent reruns.
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.timings = EndpointTimings()
+
+    def request(self, endpoint: str, method: str, url: str, timeout: Optional[float] = None, **kwargs) -> requests.Response:
+        # `endpoint` is the name the call is timed under
+        started = time.perf_counter()
+        ok = False
+        try:
+            resp = self.session.request(method, url, timeout=(CONNECT_TIMEOUT, timeout), **kwargs)
+            ok = resp.status_code < 400
+            return resp
+        finally:
+            self.timings.record(endpoint, time.perf_counter() - started, ok)
+
+    def get(self, endpoint: str, url: str, **kwargs) -> requests.Response:
+        return self.request(endpoint, "GET", url, **kwargs)
+
+    def post(self, endpoint: str, url: str, **kwargs) -> requests.Response:
+        return self.request(endpoint, "POST", url, **kwargs)
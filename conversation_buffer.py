@@ -0,0 +1,104 @@
+from bisect import bisect_left
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Messages of the conversation open in a console, kept in st.session_state
+# across reruns. Messages are indexed by a stable id (hub messages use
+# "hub-<epoch>-<seq>", local sends a temporary id) and kept sorted by their parsed
+# timestamp, so merging a poll result costs O(new messages) and rendering
+# never has to sort or dedup the whole conversation again.
+
+
+def parse_time(ts: Any) -> float:
+    # Epoch seconds of an ISO-8601 timestamp (naive means UTC); 0.0 if unparseable
+    if isinstance(ts, (int, float)):
+        return float(ts)
+    try:
+        dt = datetime.fromisoformat(str(ts).replace("Z", "+00:00"))
+    except ValueError:
+        return 0.0
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+class ConversationBuffer:
+    def __init__(self):
+        self._by_id: Dict[str, Dict[str, Any]] = {}
+        self._key_of: Dict[str, Tuple[float, str]] = {}
+        # parallel lists, sorted by (time, id)
+        self._keys: List[Tuple[float, str]] = []
+        self._messages: List[Dict[str, Any]] = []
+        # added or updated since the last drain_changes(), for the chat view
+        self._changes: List[Dict[str, Any]] = []
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __contains__(self, msg_id: str) -> bool:
+        return msg_id in self._by_id
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(self._messages)
+
+    @property
+    def messages(self) -> List[Dict[str, Any]]:
+        # Sorted by timestamp; do not modify in place, use upsert()
+        return self._messages
+
+    def get(self, msg_id: str) -> Optional[Dict[str, Any]]:
+        return self._by_id.get(msg_id)
+
+    def upsert(self, msg: Dict[str, Any]) -> bool:
+        # Adds a message, or replaces the one with the same id. The message
+        # needs an "id" and a "createdAt"; "epoch" (seconds) is the sort time,
+        # parsed from createdAt if the caller does not provide it (hub
+        # messages carry it pre-parsed). Returns True if it was new.
+        msg_id = msg["id"]
+        if "epoch" not in msg:
+            msg["epoch"] = parse_time(msg.get("createdAt"))
+        key = (msg["epoch"], msg_id)
+        old = self._by_id.get(msg_id)
+        if old is not None:
+            self._remove(msg_id)
+        self._by_id[msg_id] = msg
+        self._key_of[msg_id] = key
+        # Polls deliver messages in order: appending is the common case
+        if not self._keys or key >= self._keys[-1]:
+            self._keys.append(key)
+            self._messages.append(msg)
+        else:
+            i = bisect_left(self._keys, key)
+            self._keys.insert(i, key)
+            self._messages.insert(i, msg)
+        self._changes.append(msg)
+        return old is None
+
+    def update(self, msg_id: str, **fields: Any) -> Optional[Dict[str, Any]]:
+        # Changes fields of a stored message (e.g. status); re-sorted if its time moved
+        msg = self._by_id.get(msg_id)
+        if msg is None:
+            return None
+        updated = {**msg, **fields}
+        if "createdAt" in fields:
+            updated.pop("epoch", None)
+        self.upsert(updated)
+        return updated
+
+    def merge(self, msgs: List[Dict[str, Any]]) -> int:
+        # Adds the messages whose id is not stored yet; returns how many
+        added = 0
+        for msg in msgs:
+            if msg["id"] not in self._by_id:
+                self.upsert(msg)
+                added += 1
+        return added
+
+    def drain_changes(self) -> List[Dict[str, Any]]:
+        changes, self._changes = self._changes, []
+        return changes
+
+    def _remove(self, msg_id: str) -> None:
+        i = bisect_left(self._keys, self._key_of[msg_id])
+        del self._keys[i]
+        del self._messages[i]
@@ -0,0 +1,94 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+# Logging for the message hub, kept off the request path: handlers on the hub
+# loggers only put records on a bounded in-memory queue, and a background
+# QueueListener thread formats them and does the blocking write to stdout.
+
+_RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line; anything passed via `extra=` becomes a field
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # The stdlib handler formats the record in the calling thread and reports a
+    # full queue through handleError (a traceback on stderr). Here the record
+    # is queued untouched and dropped, counted, when the queue is full.
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RateLimitFilter(logging.Filter):
+    # Token bucket for high-volume records (one per message): at most `rate`
+    # records per second with bursts of `burst`. The next record that gets
+    # through carries the number suppressed since the previous one.
+    def __init__(self, rate: float, burst: float = 0.0):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                self._suppressed += 1
+                return False
+            self._tokens -= 1
+            if self._suppressed:
+                record.suppressed = self._suppressed
+                self._suppressed = 0
+        return True
+
+
+def setup_logging(level: str = "INFO", queue_size: int = 10000, stream=None) -> logging.handlers.QueueListener:
+    # Routes the "hub" logger tree through a background listener; the caller
+    # stops the returned listener at shutdown to flush what is still queued.
+    records: queue.Queue = queue.Queue(queue_size)
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=False)
+
+    logger = logging.getLogger("hub")
+    logger.setLevel(level.upper())
+    logger.handlers[:] = [DroppingQueueHandler(records)]
+    logger.propagate = False
+    listener.start()
+    return listener
@@ -0,0 +1,121 @@
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Minimal Prometheus instrumentation for the message hub (text format 0.0.4).
+# Metrics are only updated from the event loop thread, so plain dict and list
+# updates are enough: no locks on the request path. Values that already live
+# elsewhere (store size, subscribers) are read at scrape time via callbacks.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+Labels = Tuple[str, ...]
+
+
+def _labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in list(self._values.items()):
+            yield f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+
+
+class Gauge:
+    # Read at scrape time: `collect` returns {label values: value}. With
+    # kind="counter" it exposes a monotonic total that is kept elsewhere.
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], Dict[Labels, float]],
+        labels: Sequence[str] = (),
+        kind: str = "gauge",
+    ):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self._collect = collect
+        self.kind = kind
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for labels, value in self._collect().items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ()):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        # per label set: one count per bucket (+Inf last), then sum, then count
+        self._values: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        slot = self._values.get(labels)
+        if slot is None:
+            slot = self._values[labels] = [0] * (len(self.buckets) + 3)
+        slot[bisect_left(self.buckets, value)] += 1
+        slot[-2] += value
+        slot[-1] += 1
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, slot in list(self._values.items()):
+            yield from self._render_slot(labels, slot)
+
+    def _render_slot(self, labels: Labels, slot: List[float]) -> Iterable[str]:
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), slot):
+            cumulative += count
+            le = f'le="{_number(bound)}"'
+            yield f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}"
+        yield f"{self.name}_sum{_labels(self.label_names, labels)} {_number(slot[-2])}"
+        yield f"{self.name}_count{_labels(self.label_names, labels)} {slot[-1]}"
+
+
+class SnapshotHistogram(Histogram):
+    # A distribution rebuilt from scratch at every scrape
+    def __init__(self, name: str, help: str, buckets: Sequence[float], collect: Callable[[], Iterable[float]]):
+        super().__init__(name, help, buckets)
+        self._collect = collect
+
+    def render(self) -> Iterable[str]:
+        self._values = {}
+        for value in self._collect():
+            self.observe(value)
+        yield from super().render()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
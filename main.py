@@ -1,12 +1,1106 @@
-from fastapi import FastAPI
-from pydantic import BaseModel
-from typing import List
-from datetime import datetime
+import asyncio
+import gc
+import gzip
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
+from itertools import islice
+from fastapi import FastAPI, Header, HTTPException, Query, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from typing import Any, Dict, List, Optional, Set, Tuple
+from datetime import datetime, timezone
 
-app = FastAPI(title="Realtime Message Hub")
+from hub_logging import RateLimitFilter, setup_logging
+from hub_metrics import LATENCY_BUCKETS, Counter, Gauge, Histogram, Registry, SnapshotHistogram
+from search_index import SearchIndex
+from storage import open_backend
 
-# In-memory store (replace with DB later)
-MESSAGES: List[dict] = []
+# Optional speedups for read responses: orjson encodes message lists several
+# times faster than the stdlib, brotli adds "br" next to gzip.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+LOG_LEVEL = os.environ.get("HUB_LOG_LEVEL", "INFO")
+# Per-message log lines allowed per second; the rest are counted, not written (0 = no limit)
+LOG_MESSAGES_PER_S = float(os.environ.get("HUB_LOG_MESSAGES_PER_S", "20"))
+
+LOG_LISTENER = setup_logging(LOG_LEVEL)
+log = logging.getLogger("hub")
+message_log = logging.getLogger("hub.messages")
+message_log.addFilter(RateLimitFilter(LOG_MESSAGES_PER_S))
+
+# Retention of the in-memory store (0 disables a limit)
+MAX_PER_CONVERSATION = int(os.environ.get("HUB_MAX_PER_CONVERSATION", "5000"))
+MESSAGE_TTL_S = float(os.environ.get("HUB_MESSAGE_TTL_S", str(7 * 24 * 3600)))
+MAX_MESSAGES = int(os.environ.get("HUB_MAX_MESSAGES", "1000000"))
+MAX_BYTES = int(os.environ.get("HUB_MAX_BYTES", str(512 * 1024 * 1024)))
+EVICT_BATCH = 64
+MSG_OVERHEAD_BYTES = 400
+EPOCH_MIN_DIGITS = 10  # numeric timestamps: epoch seconds since 2001-09-09, or milliseconds
+
+BATCH_MAX_ITEMS = int(os.environ.get("HUB_BATCH_MAX_ITEMS", "5000"))
+# Idempotent ingest: keys of recently ingested messages are remembered, up to
+# this many and for this long (0 disables duplicate detection). Shared storage
+# keeps them in the database for all workers; in sqlite mode the content keys
+# of the replayed messages are rebuilt at startup.
+DEDUP_WINDOW = int(os.environ.get("HUB_DEDUP_WINDOW", "200000"))
+DEDUP_TTL_S = float(os.environ.get("HUB_DEDUP_TTL_S", str(24 * 3600)))
+# Admission control on the webhooks (0 disables a limit): a token bucket per
+# tenantPhone (messages per second, and the burst it may send at once), and a
+# bound on the messages queued for the store. Over either limit: 429 + Retry-After.
+# Only new messages count, redeliveries are acknowledged regardless. Both
+# limits are per process: with uvicorn --workers N a tenant gets up to
+# N x HUB_TENANT_RATE, so set it to the intended total divided by N.
+TENANT_RATE = float(os.environ.get("HUB_TENANT_RATE", "100"))
+TENANT_BURST = float(os.environ.get("HUB_TENANT_BURST", "1000"))
+INGEST_QUEUE_MAX = int(os.environ.get("HUB_INGEST_QUEUE_MAX", "50000"))
+# Large batches are stored in chunks; between chunks, reads waiting to be
+# answered go first (for at most HUB_READ_PRIORITY_WAIT_S per chunk)
+INGEST_CHUNK = int(os.environ.get("HUB_INGEST_CHUNK", "500"))
+READ_PRIORITY_WAIT_S = float(os.environ.get("HUB_READ_PRIORITY_WAIT_S", "0.05"))
+
+STREAM_QUEUE_SIZE = int(os.environ.get("HUB_STREAM_QUEUE_SIZE", "1000"))
+STREAM_HEARTBEAT_S = float(os.environ.get("HUB_STREAM_HEARTBEAT_S", "15"))
+# Read pages: `limit` defaults to HUB_PAGE_LIMIT and may not exceed HUB_PAGE_LIMIT_MAX
+PAGE_LIMIT = int(os.environ.get("HUB_PAGE_LIMIT", "1000"))
+PAGE_LIMIT_MAX = int(os.environ.get("HUB_PAGE_LIMIT_MAX", "10000"))
+MAX_PHONES_PER_QUERY = int(os.environ.get("HUB_MAX_PHONES_PER_QUERY", "500"))
+# Full-text index over message text for /messages/search (HUB_SEARCH_INDEX=0
+# disables it; the endpoint then answers 503). It is not free: in-memory ingest
+# drops to about a third (~270k to ~75k msg/s), replaying storage at startup
+# takes 1.5-2.5x as long, and it holds about half as much memory again as the
+# messages it indexes, which counts toward HUB_MAX_BYTES.
+SEARCH_INDEX = os.environ.get("HUB_SEARCH_INDEX", "1") == "1"
+SEARCH_LIMIT = int(os.environ.get("HUB_SEARCH_LIMIT", "50"))
+PLAN_SAMPLE = 64  # conversations looked at to size a phone/tenant filter when planning a search
+# Read responses at least this large are compressed when the client accepts it
+COMPRESS_MIN_BYTES = int(os.environ.get("HUB_COMPRESS_MIN_BYTES", "1024"))
+
+# Consoles in "stream" mode open the event stream from the browser, so it must
+# allow their origin: HUB_CORS_ORIGINS, comma-separated (e.g. the console's
+# http://host:8501). Unset means no CORS at all. The hub has no auth, so only
+# the routes in CORS_PATHS are opened up, never the read and search routes.
+CORS_ORIGINS = [o.strip() for o in os.environ.get("HUB_CORS_ORIGINS", "").split(",") if o.strip()]
+CORS_PATHS = ("/messages/stream",)
+
+# Durable storage: "memory" (nothing survives a restart), "sqlite", or "shared"
+# (SQLite shared by all worker processes on the host, for uvicorn --workers N)
+STORAGE_BACKEND = os.environ.get("HUB_STORAGE", "memory")
+SQLITE_PATH = os.environ.get("HUB_SQLITE_PATH", "hub.db")
+SQLITE_SYNCHRONOUS = os.environ.get("HUB_SQLITE_SYNCHRONOUS", "NORMAL")
+# Acknowledge webhooks only after their batch is committed to storage
+DURABLE_ACK = os.environ.get("HUB_DURABLE_ACK", "1") == "1"
+# How often a worker in shared mode looks for messages ingested by the others
+SYNC_INTERVAL_S = float(os.environ.get("HUB_SYNC_INTERVAL_S", "0.05"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    load_messages()
+    follower = asyncio.create_task(follow_storage()) if STORAGE.shared else None
+    yield
+    if follower is not None:
+        follower.cancel()
+    INGEST_QUEUE.close()
+    STORAGE.close()
+    LOG_LISTENER.stop()
+
+
+class StreamCORSMiddleware:
+    # CORSMiddleware for the routes in CORS_PATHS; the others answer without
+    # CORS headers, so browsers keep other origins from reading them
+    def __init__(self, app):
+        self.app = app
+        self.cors = CORSMiddleware(app, allow_origins=CORS_ORIGINS, allow_methods=["GET"], allow_headers=["*"])
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in CORS_PATHS:
+            await self.cors(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+app = FastAPI(title="Realtime Message Hub", lifespan=lifespan)
+if CORS_ORIGINS:
+    app.add_middleware(StreamCORSMiddleware)
+
+
+def _msg_size(msg: dict) -> int:
+    # Rough resident size of a stored message: dict and object headers plus
+    # the string payloads. Only used to enforce HUB_MAX_BYTES.
+    size = MSG_OVERHEAD_BYTES
+    for value in msg.values():
+        if value.__class__ is str:
+            size += len(value)
+    return size
+
+
+def _epoch_ms(value: Any, default: float) -> int:
+    # Message time as integer epoch milliseconds, parsed once at ingest so that
+    # sorting and range filters compare integers. `value` is the n8n timestamp:
+    # ISO-8601 (naive means UTC) or a numeric epoch in seconds or milliseconds.
+    # Digit strings shorter than EPOCH_MIN_DIGITS are dates ("20240101"), not
+    # epochs. Missing or unparseable values fall back to `default` (epoch seconds).
+    if value is not None and value != "":
+        numeric = isinstance(value, (int, float))
+        if numeric or (value.isascii() and value.isdigit() and len(value) >= EPOCH_MIN_DIGITS):
+            try:
+                number = float(value)
+                return int(number if number > 1e11 else number * 1000)
+            except (ValueError, OverflowError):
+                return int(default * 1000)
+        try:
+            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            pass
+        else:
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            return int(dt.timestamp() * 1000)
+    return int(default * 1000)
+
+
+class Conversation:
+    # Messages of one patientPhone in seq order, with their receive times.
+    # Dropping from the head only advances `start`; the lists are compacted once
+    # the dead prefix is more than half of them, so trimming is amortized O(1).
+    __slots__ = ("messages", "times", "start", "bytes", "tenants", "chats")
+
+    def __init__(self):
+        self.messages: List[Optional[dict]] = []
+        self.times: List[float] = []
+        self.start = 0
+        self.bytes = 0
+        self.tenants: Set[str] = set()
+        self.chats: Set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self.messages) - self.start
+
+    def append(self, msg: dict, received: float, size: int) -> None:
+        self.messages.append(msg)
+        self.times.append(received)
+        self.bytes += size
+
+    def drop_head(self, n: int) -> int:
+        # Returns the bytes freed
+        end = self.start + n
+        freed = 0
+        for i in range(self.start, end):
+            freed += _msg_size(self.messages[i])
+            self.messages[i] = None
+        self.start = end
+        if self.start > 64 and self.start * 2 > len(self.messages):
+            del self.messages[:self.start]
+            del self.times[:self.start]
+            self.start = 0
+        self.bytes -= freed
+        return freed
+
+    def take(self, msg: dict) -> bool:
+        # Removes `msg` if it is still held (linear, for the rare failed ingest)
+        i = bisect_left(self.messages, msg["seq"], self.start, key=lambda m: m["seq"])
+        if i == len(self.messages) or self.messages[i] is not msg:
+            return False
+        del self.messages[i]
+        del self.times[i]
+        self.bytes -= _msg_size(msg)
+        return True
+
+    def expired(self, cutoff: float, budget: int) -> int:
+        # Number of head messages received before `cutoff`, looking at most `budget` deep
+        hi = min(len(self.times), self.start + budget)
+        return bisect_left(self.times, cutoff, self.start, hi) - self.start
+
+    def after(self, since: int, cutoff: float, before: Optional[int] = None) -> List[dict]:
+        # Live messages with seq > since, and seq < before if given (receive
+        # times and seqs are both ascending)
+        lo = self.start
+        if cutoff:
+            lo = bisect_left(self.times, cutoff, lo)
+        if since:
+            lo = bisect_right(self.messages, since, lo, key=lambda m: m["seq"])
+        if before is None:
+            return self.messages[lo:]
+        hi = bisect_left(self.messages, before, lo, key=lambda m: m["seq"])
+        return self.messages[lo:hi]
+
+
+class MessageStore:
+    # The in-memory query index over STORAGE: the backend (storage.py) makes
+    # messages durable, this answers every read. Messages are kept per
+    # conversation, keyed by patientPhone, with secondary indexes from
+    # tenantPhone and chatId to conversations, so a lookup only touches the
+    # messages of the conversations involved.
+    # Every message is stamped with a monotonically increasing "seq" at ingest;
+    # conversations are therefore sorted by seq and "since" cursors are a bisect.
+    #
+    # Retention (0 disables a limit):
+    # - max_per_conversation: ring-buffer cap, the oldest message is dropped
+    # - ttl_s: messages older than this (by receive time) are dropped
+    # - max_messages / max_bytes: global ceiling, the least recently used
+    #   conversation is evicted as a whole; max_bytes covers the search index
+    # Eviction runs inline with ingest but does a bounded amount of work per
+    # message (at most EVICT_BATCH head drops plus whole-conversation pops), so
+    # the webhook never stalls. Expired messages not swept yet are already
+    # hidden from reads.
+    #
+    # With search=True the message text is also kept in a SearchIndex, which
+    # follows every add and every retention drop.
+    def __init__(
+        self,
+        max_per_conversation: int = MAX_PER_CONVERSATION,
+        ttl_s: float = MESSAGE_TTL_S,
+        max_messages: int = MAX_MESSAGES,
+        max_bytes: int = MAX_BYTES,
+        clock=time.time,
+        search: bool = SEARCH_INDEX,
+    ):
+        self.max_per_conversation = max_per_conversation
+        self.ttl_s = ttl_s
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._clock = clock
+        # Ordered least -> most recently used (read or written)
+        self._convs: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._by_tenant: Dict[str, Set[str]] = defaultdict(set)
+        self._by_chat: Dict[str, Set[str]] = defaultdict(set)
+        self._count = 0
+        self._bytes = 0
+        self._seq = 0
+        self.evicted = {"cap": 0, "ttl": 0, "lru": 0}
+        self.index: Optional[SearchIndex] = SearchIndex() if search else None
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def last_seq(self) -> int:
+        return self._seq
+
+    def conversation_sizes(self):
+        return (len(conv) for conv in self._convs.values())
+
+    def continue_from(self, seq: int) -> None:
+        # New seqs continue after `seq` (the highest one storage ever wrote)
+        self._seq = max(self._seq, seq)
+
+    def stats(self) -> dict:
+        return {
+            "messages": self._count,
+            "conversations": len(self._convs),
+            "bytes": self._bytes,
+            "lastSeq": self._seq,
+            "evicted": dict(self.evicted),
+            "index": self.index.stats() if self.index is not None else None,
+        }
+
+    def add(self, msg: dict, received: Optional[float] = None) -> int:
+        # Messages from shared storage arrive with their seq already assigned
+        now = self._clock()
+        if received is None:
+            received = now
+        if "seq" in msg:
+            self._seq = msg["seq"]
+        else:
+            self._seq += 1
+            msg["seq"] = self._seq
+        if "ts" not in msg:
+            msg["ts"] = _epoch_ms(msg.get("timestamp"), received)
+        key = msg["patientPhone"]
+        conv = self._convs.get(key)
+        if conv is None:
+            conv = self._convs[key] = Conversation()
+        else:
+            self._convs.move_to_end(key)
+        if msg["tenantPhone"] not in conv.tenants:
+            conv.tenants.add(msg["tenantPhone"])
+            self._by_tenant[msg["tenantPhone"]].add(key)
+        if msg["chatId"] not in conv.chats:
+            conv.chats.add(msg["chatId"])
+            self._by_chat[msg["chatId"]].add(key)
+
+        size = _msg_size(msg)
+        conv.append(msg, received, size)
+        self._count += 1
+        self._bytes += size
+        if self.index is not None:
+            self.index.add(msg)
+
+        if self.max_per_conversation and len(conv) > self.max_per_conversation:
+            self._drop(conv, len(conv) - self.max_per_conversation, "cap")
+        self._evict(now)
+        return self._seq
+
+    def discard(self, msgs) -> None:
+        # Takes back messages whose ingest failed after they were added (their
+        # rows could not be persisted), unless they were evicted meanwhile
+        for msg in msgs:
+            key = msg["patientPhone"]
+            conv = self._convs.get(key)
+            if conv is None or not conv.take(msg):
+                continue
+            self._count -= 1
+            self._bytes -= _msg_size(msg)
+            if self.index is not None:
+                self.index.remove([msg])
+            if not len(conv):
+                self._remove(key, "lru")  # empty: counts nothing as evicted
+
+    def load(self, rows) -> int:
+        # Bulk path for replaying storage at startup: rows of (msg, received) in
+        # seq order. Indexes are filled directly and retention is applied once
+        # at the end instead of per message. The cyclic GC is paused meanwhile:
+        # millions of new dicts would otherwise trigger repeated full scans.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._load(rows)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    def _load(self, rows) -> int:
+        convs = self._convs
+        count = 0
+        for msg, received in rows:
+            key = msg["patientPhone"]
+            conv = convs.get(key)
+            if conv is None:
+                conv = convs[key] = Conversation()
+            if msg["tenantPhone"] not in conv.tenants:
+                conv.tenants.add(msg["tenantPhone"])
+                self._by_tenant[msg["tenantPhone"]].add(key)
+            if msg["chatId"] not in conv.chats:
+                conv.chats.add(msg["chatId"])
+                self._by_chat[msg["chatId"]].add(key)
+            # Stored before messages carried "ts"
+            if "ts" not in msg:
+                msg["ts"] = _epoch_ms(msg.get("timestamp"), received)
+            conv.append(msg, received, _msg_size(msg))
+            if self.index is not None:
+                self.index.add(msg)
+            count += 1
+            if msg["seq"] > self._seq:
+                self._seq = msg["seq"]
+
+        # LRU order = order of last activity
+        for key in sorted(convs, key=lambda k: convs[k].times[-1]):
+            convs.move_to_end(key)
+        self._count = sum(len(c) for c in convs.values())
+        self._bytes = sum(c.bytes for c in convs.values())
+        for conv in list(convs.values()):
+            if self.max_per_conversation and len(conv) > self.max_per_conversation:
+                self._drop(conv, len(conv) - self.max_per_conversation, "cap")
+        self._evict(self._clock())
+        return count
+
+    def _cutoff(self, now: float) -> float:
+        return now - self.ttl_s if self.ttl_s else 0.0
+
+    def _drop(self, conv: Conversation, n: int, reason: str) -> None:
+        if self.index is not None:
+            self.index.remove(conv.messages[conv.start:conv.start + n])
+        self._bytes -= conv.drop_head(n)
+        self._count -= n
+        self.evicted[reason] += n
+
+    def _remove(self, key: str, reason: str) -> None:
+        conv = self._convs.pop(key)
+        if self.index is not None:
+            self.index.remove(conv.messages[conv.start:])
+        for index, values in ((self._by_tenant, conv.tenants), (self._by_chat, conv.chats)):
+            for value in values:
+                keys = index.get(value)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del index[value]
+        self._count -= len(conv)
+        self._bytes -= conv.bytes
+        self.evicted[reason] += len(conv)
+
+    def _evict(self, now: float) -> None:
+        # TTL: sweep the least recently used conversation a little per ingest
+        cutoff = self._cutoff(now)
+        if cutoff and self._convs:
+            key, conv = next(iter(self._convs.items()))
+            if conv.times[-1] < cutoff:
+                self._remove(key, "ttl")
+            else:
+                n = conv.expired(cutoff, EVICT_BATCH)
+                if n:
+                    self._drop(conv, n, "ttl")
+
+        # Global ceiling: evict idle conversations, LRU first. The conversation
+        # that is being written to is only trimmed, never dropped.
+        while (
+            (self.max_messages and self._count > self.max_messages)
+            or (self.max_bytes and self._resident_bytes() > self.max_bytes)
+        ):
+            key, conv = next(iter(self._convs.items()))
+            if len(self._convs) > 1:
+                self._remove(key, "lru")
+            elif len(conv) > 1:
+                self._drop(conv, 1, "lru")
+            else:
+                break
+
+    def _resident_bytes(self) -> int:
+        return self._bytes + (self.index.nbytes if self.index is not None else 0)
+
+    def _touch(self, key: str) -> Optional[Conversation]:
+        conv = self._convs.get(key)
+        if conv is not None:
+            self._convs.move_to_end(key)
+        return conv
+
+    @staticmethod
+    def _page(
+        msgs,
+        since: int,
+        limit: Optional[int],
+        newest: bool = False,
+        ts_from: Optional[int] = None,
+        ts_to: Optional[int] = None,
+    ) -> Tuple[List[dict], int, bool]:
+        # Returns (messages with seq > since and ts_from <= "ts" < ts_to, next
+        # cursor, more pending).
+        # With newest=True `msgs` comes newest first and the page holds the
+        # newest `limit` of them (a `before` page; "more" means older ones);
+        # pages are always returned in ascending seq order.
+        # A forward page that reaches the end of `msgs` moves the cursor past
+        # the last message scanned even if the range filtered it out, so that
+        # polling a range does not scan the same messages again every time.
+        scanned = [since]
+        if not newest and (ts_from is not None or ts_to is not None):
+            msgs = MessageStore._scanning(msgs, scanned)
+        msgs = MessageStore._in_range(msgs, ts_from, ts_to)
+        if limit is None:
+            page = list(msgs)
+            has_more = False
+        else:
+            page = list(islice(msgs, limit + 1))
+            has_more = len(page) > limit
+            del page[limit:]
+        if newest:
+            page.reverse()
+        cursor = page[-1]["seq"] if page else since
+        if not newest and not has_more:
+            cursor = max(cursor, scanned[0])
+        return page, cursor, has_more
+
+    @staticmethod
+    def _scanning(msgs, scanned: List[int]):
+        # Passes `msgs` through, keeping the seq of the last one in scanned[0]
+        for msg in msgs:
+            scanned[0] = msg["seq"]
+            yield msg
+
+    @staticmethod
+    def _in_range(msgs, ts_from: Optional[int], ts_to: Optional[int]):
+        # Messages with ts_from <= "ts" < ts_to (epoch ms, either bound optional)
+        if ts_from is None and ts_to is None:
+            return msgs
+        lo = ts_from if ts_from is not None else float("-inf")
+        hi = ts_to if ts_to is not None else float("inf")
+        return (m for m in msgs if lo <= m["ts"] < hi)
+
+    def _merged(self, keys, field: Optional[str], value: Optional[str], since: int, before, newest: bool, touch=True):
+        # The messages of several conversations (those with m[field] == value
+        # if a field is given) merged back into seq order, newest first if asked
+        cutoff = self._cutoff(self._clock())
+        streams = []
+        for key in keys:
+            conv = self._touch(key) if touch else self._convs.get(key)
+            if conv is not None:
+                window = conv.after(since, cutoff, before)
+                msgs = reversed(window) if newest else iter(window)
+                if field is not None:
+                    msgs = (m for m in msgs if m[field] == value)
+                streams.append(msgs)
+        return heapq.merge(*streams, key=lambda m: m["seq"], reverse=newest)
+
+    def _collect(self, keys, field: str, value: str, since: int, limit: Optional[int], ts_from, ts_to, before):
+        # Newest first for a `before` page
+        newest = before is not None
+        merged = self._merged(keys, field, value, since, before, newest)
+        return self._page(merged, since, limit, newest, ts_from, ts_to)
+
+    # ts_from/ts_to filter on the message time ("ts", epoch ms). Messages of a
+    # conversation are in seq order, not necessarily in time order, so the
+    # range is a filter over the (capped) conversation rather than a bisect.
+    # `before` (a seq) pages backwards: the newest `limit` messages older than it.
+    def by_patient(
+        self,
+        patient_phone: str,
+        since: int = 0,
+        limit: Optional[int] = None,
+        ts_from: Optional[int] = None,
+        ts_to: Optional[int] = None,
+        before: Optional[int] = None,
+    ):
+        conv = self._touch(patient_phone)
+        if conv is None:
+            return [], since, False
+        window = conv.after(since, self._cutoff(self._clock()), before)
+        if before is not None:
+            return self._page(reversed(window), since, limit, True, ts_from, ts_to)
+        return self._page(window, since, limit, False, ts_from, ts_to)
+
+    def by_patients(
+        self,
+        patient_phones: List[str],
+        since: int = 0,
+        limit: Optional[int] = None,
+        ts_from: Optional[int] = None,
+        ts_to: Optional[int] = None,
+    ):
+        # Several conversations with one seq cursor: seqs are global, so a
+        # dashboard keeps a single cursor for everything it watches
+        keys = list(dict.fromkeys(patient_phones))
+        return self._collect(keys, None, None, since, limit, ts_from, ts_to, None)
+
+    def by_tenant(
+        self,
+        tenant_phone: str,
+        since: int = 0,
+        limit: Optional[int] = None,
+        ts_from: Optional[int] = None,
+        ts_to: Optional[int] = None,
+        before: Optional[int] = None,
+    ):
+        keys = list(self._by_tenant.get(tenant_phone, ()))
+        return self._collect(keys, "tenantPhone", tenant_phone, since, limit, ts_from, ts_to, before)
+
+    def by_chat(
+        self,
+        chat_id: str,
+        since: int = 0,
+        limit: Optional[int] = None,
+        ts_from: Optional[int] = None,
+        ts_to: Optional[int] = None,
+        before: Optional[int] = None,
+    ):
+        keys = list(self._by_chat.get(chat_id, ()))
+        return self._collect(keys, "chatId", chat_id, since, limit, ts_from, ts_to, before)
+
+    def search(
+        self,
+        query: str,
+        patient_phone: Optional[str] = None,
+        tenant_phone: Optional[str] = None,
+        since: int = 0,
+        limit: Optional[int] = None,
+        ts_from: Optional[int] = None,
+        ts_to: Optional[int] = None,
+        before: Optional[int] = None,
+    ):
+        # Messages whose text matches every term of `query` (see
+        # SearchIndex.clauses), newest first: the page holds the newest `limit`
+        # matches and hasMore means older ones remain (page on with `before`).
+        # The walk is driven either by the postings of the rarest query term or
+        # by the conversations of the phone/tenant filter, whichever is expected
+        # to reach `limit` hits sooner; the other side is only probed. Raises
+        # ValueError for queries the index cannot answer.
+        if self.index is None:
+            raise ValueError("search index is disabled")
+        clauses = self.index.clauses(query)
+        if clauses is None:
+            return [], since, False
+        if patient_phone is not None:
+            keys = [patient_phone]
+            field, value = ("tenantPhone", tenant_phone) if tenant_phone is not None else (None, None)
+        elif tenant_phone is not None:
+            keys = self._by_tenant.get(tenant_phone, ())
+            field, value = "tenantPhone", tenant_phone
+        else:
+            keys = None
+        if keys is not None and self._drive_by_conversations(keys, self.index.size(clauses[0]), limit):
+            merged = self._merged(keys, field, value, since, before, newest=True, touch=False)
+            msgs = (m for m in merged if self.index.matches(clauses, m["seq"]))
+        else:
+            msgs = self._live(self.index.candidates(clauses, since, before))
+            if patient_phone is not None:
+                msgs = (m for m in msgs if m["patientPhone"] == patient_phone)
+            if tenant_phone is not None:
+                msgs = (m for m in msgs if m["tenantPhone"] == tenant_phone)
+        return self._page(msgs, since, limit, True, ts_from, ts_to)
+
+    def _drive_by_conversations(self, keys, postings: int, limit: Optional[int]) -> bool:
+        # Expected messages visited by each plan, taking the filter and the
+        # term as independent: walking the postings, a fraction in_convs/count
+        # passes the filter; walking the conversations (plus one heap entry per
+        # conversation), a fraction postings/count has the term. A tenant can
+        # have many conversations: their size is estimated from a sample.
+        sample = [len(self._convs[k]) for k in islice(keys, PLAN_SAMPLE) if k in self._convs]
+        in_convs = sum(sample) * len(keys) / PLAN_SAMPLE if len(keys) > PLAN_SAMPLE else sum(sample)
+        if not in_convs or not self._count:
+            return True
+        wanted = limit if limit is not None else self._count
+        by_postings = min(postings, wanted * self._count / in_convs)
+        by_convs = len(keys) + min(in_convs, wanted * self._count / max(postings, 1))
+        return by_convs < by_postings
+
+    def _live(self, msgs):
+        # Hides indexed messages past the TTL that retention has not swept yet,
+        # looking up the first live seq of each conversation once
+        cutoff = self._cutoff(self._clock())
+        if not cutoff:
+            return msgs
+        first_live: Dict[str, float] = {}
+
+        def live(msg: dict) -> bool:
+            key = msg["patientPhone"]
+            seq = first_live.get(key)
+            if seq is None:
+                seq = float("inf")
+                conv = self._convs.get(key)
+                if conv is not None:
+                    i = bisect_left(conv.times, cutoff, conv.start)
+                    if i < len(conv.messages):
+                        seq = conv.messages[i]["seq"]
+                first_live[key] = seq
+            return msg["seq"] >= seq
+
+        return (m for m in msgs if live(m))
+
+
+class Subscription:
+    # A bounded queue per stream. If the consumer falls behind, the queue is not
+    # grown: `overflowed` is set instead and the stream catches up from the store.
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self.reset()
+
+    def reset(self) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue(self._maxsize)
+        self.overflowed = False
+
+
+class Broker:
+    # In-process pub/sub keyed by patientPhone; publish never blocks the webhook.
+    def __init__(self, queue_size: int = STREAM_QUEUE_SIZE):
+        self._subs: Dict[str, Set[Subscription]] = defaultdict(set)
+        self._queue_size = queue_size
+
+    def subscriber_count(self) -> int:
+        return sum(len(s) for s in self._subs.values())
+
+    def subscribe(self, key: str) -> Subscription:
+        sub = Subscription(self._queue_size)
+        self._subs[key].add(sub)
+        return sub
+
+    def unsubscribe(self, key: str, sub: Subscription) -> None:
+        subs = self._subs.get(key)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                del self._subs[key]
+
+    def publish(self, key: str, msg: dict) -> None:
+        for sub in self._subs.get(key, ()):
+            if sub.overflowed:
+                continue
+            try:
+                sub.queue.put_nowait(msg)
+            except asyncio.QueueFull:
+                sub.overflowed = True
+
+
+class ActivePollers:
+    # patientPhones polled within the last `window_s` seconds. Stale entries
+    # are pruned when counting, and on insert once the map gets large.
+    def __init__(self, window_s: float = 10.0, max_size: int = 100000):
+        self.window_s = window_s
+        self.max_size = max_size
+        self._last: Dict[str, float] = {}
+
+    def touch(self, key: str) -> None:
+        self._last[key] = time.monotonic()
+        if len(self._last) > self.max_size:
+            self.count()
+
+    def count(self) -> int:
+        cutoff = time.monotonic() - self.window_s
+        self._last = {k: t for k, t in self._last.items() if t >= cutoff}
+        return len(self._last)
+
+
+class RecentKeys:
+    # Idempotency keys of recently ingested messages, mapped to their seq, or
+    # to a future while the first delivery is still being stored (it resolves
+    # to the seq, or to None if that delivery failed), oldest first.
+    # Bounded by count and by age: lookups and inserts are O(1) and every key
+    # (a 16-byte digest) costs roughly 150 bytes.
+    def __init__(self, max_size: int = DEDUP_WINDOW, ttl_s: float = DEDUP_TTL_S):
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self._keys: "OrderedDict[bytes, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def get(self, key: bytes) -> Any:
+        # The seq or pending future of a live key, else None
+        entry = self._keys.get(key)
+        if entry is None or (self.ttl_s and entry[0] < time.monotonic() - self.ttl_s):
+            return None
+        return entry[1]
+
+    def add(self, key: bytes, value: Any, age_s: float = 0.0) -> None:
+        # A key that is already there keeps its age; only its value is replaced.
+        # Keys must be added oldest first (age_s: how long ago the message came in).
+        entry = self._keys.get(key)
+        now = time.monotonic()
+        self._keys[key] = (entry[0] if entry is not None else now - age_s, value)
+        cutoff = now - self.ttl_s if self.ttl_s else None
+        while self._keys:
+            oldest = next(iter(self._keys.values()))[0]
+            if len(self._keys) <= self.max_size and (cutoff is None or oldest >= cutoff):
+                break
+            self._keys.popitem(last=False)
+
+    def discard(self, key: bytes) -> None:
+        self._keys.pop(key, None)
+
+
+class TokenBuckets:
+    # A token bucket per key (tenantPhone): refilled at `rate` tokens per
+    # second, holding at most `burst`. A request larger than the burst is let
+    # through once the bucket is full, leaving it in debt, which delays the
+    # next ones. Full buckets are pruned once the map gets large.
+    def __init__(self, rate: float = TENANT_RATE, burst: float = TENANT_BURST, max_size: int = 100000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self._clock = clock
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    def _level(self, key: str, now: float) -> float:
+        entry = self._buckets.get(key)
+        if entry is None:
+            return self.burst
+        tokens, last = entry
+        return min(self.burst, tokens + (now - last) * self.rate)
+
+    def take(self, counts: Dict[str, int]) -> float:
+        # Takes counts[key] tokens from every bucket, or from none; returns 0.0
+        # on success, else the seconds until the request would be let through
+        if not self.rate:
+            return 0.0
+        now = self._clock()
+        levels = {key: self._level(key, now) for key in counts}
+        wait = max((min(n, self.burst) - levels[key]) / self.rate for key, n in counts.items())
+        if wait > 0:
+            return wait
+        for key, n in counts.items():
+            self._buckets[key] = (levels[key] - n, now)
+        if len(self._buckets) > self.max_size:
+            self._buckets = {k: v for k, v in self._buckets.items() if self._level(k, now) < self.burst}
+        return 0.0
+
+
+class ReadPriority:
+    # GET requests that have not started their response yet (counted by
+    # ReadPriorityMiddleware). Bulk ingest yields to them between chunks.
+    def __init__(self, max_wait_s: float = READ_PRIORITY_WAIT_S):
+        self.max_wait_s = max_wait_s
+        self.active = 0
+
+    async def yield_to_reads(self) -> None:
+        await asyncio.sleep(0)
+        deadline = time.monotonic() + self.max_wait_s
+        while self.active and time.monotonic() < deadline:
+            await asyncio.sleep(0)
+
+
+class IngestQueue:
+    # Validated webhook messages on their way into the store, written one
+    # request at a time by a single task (started on first use, per event
+    # loop). `pending` counts the queued messages; full() tells the webhooks to
+    # answer 429 rather than queue more, retry_after() estimates from the
+    # recent drain rate when there will be room again.
+    # While nothing is queued, a request of at most `inline_max` messages is
+    # written right away instead: `write` does not yield for those, so this
+    # keeps the order and saves the handoff on the common path.
+    def __init__(self, write, max_pending: int = INGEST_QUEUE_MAX, inline_max: int = INGEST_CHUNK):
+        self._write = write
+        self.max_pending = max_pending
+        self.inline_max = inline_max
+        self.pending = 0
+        self.rate = 0.0  # messages per second, moving average
+        self._loop = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def full(self, n: int) -> bool:
+        return bool(self.max_pending) and self.pending > 0 and self.pending + n > self.max_pending
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.pending / self.rate)) if self.rate else 1
+
+    async def submit(self, msgs: List[dict], received: float, keys: List[Optional[bytes]]):
+        if not self.pending and len(msgs) <= self.inline_max:
+            return await self._write(msgs, received, keys)
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self.pending = 0
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        self.pending += len(msgs)
+        self._queue.put_nowait((msgs, received, keys, future))
+        return await future
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self) -> None:
+        while True:
+            msgs, received, keys, future = await self._queue.get()
+            started = time.monotonic()
+            try:
+                result = await self._write(msgs, received, keys)
+            except Exception as exc:
+                if not future.done():
+                    future.set_exception(exc)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.pending -= len(msgs)
+            elapsed = time.monotonic() - started
+            if elapsed > 0:
+                self.rate = 0.8 * self.rate + 0.2 * (len(msgs) / elapsed) if self.rate else len(msgs) / elapsed
+
+
+MESSAGES = MessageStore()
+BROKER = Broker()
+POLLERS = ActivePollers()
+RECENT_KEYS = RecentKeys()
+TENANT_BUCKETS = TokenBuckets()
+READS = ReadPriority()
+STORAGE = open_backend(
+    STORAGE_BACKEND,
+    SQLITE_PATH,
+    ttl_s=MESSAGE_TTL_S,
+    synchronous=SQLITE_SYNCHRONOUS,
+    dedup_window=DEDUP_WINDOW,
+    dedup_ttl_s=DEDUP_TTL_S,
+)
+# Seqs are only comparable within an epoch: a new one starts whenever seqs
+# start over (every restart with HUB_STORAGE=memory, a new database otherwise)
+EPOCH = STORAGE.epoch
+
+# ---------------- METRICS ----------------
+METRICS = Registry()
+REQUESTS = METRICS.register(Counter(
+    "hub_http_requests_total", "HTTP requests by route, method and status", ("route", "method", "status")
+))
+REQUEST_LATENCY = METRICS.register(Histogram(
+    "hub_http_request_duration_seconds",
+    "Time until the response starts (streams: until the stream opens), by route",
+    LATENCY_BUCKETS,
+    ("route",),
+))
+INGESTED = METRICS.register(Counter(
+    "hub_ingested_messages_total", "Messages stored by the webhooks (redeliveries not included)"
+))
+REJECTED = METRICS.register(Counter(
+    "hub_rejected_messages_total",
+    "Webhook messages answered with 429, by reason (rate: tenant over its rate, queue: ingest queue full)",
+    ("reason",),
+))
+METRICS.register(Gauge(
+    "hub_ingest_queue_messages", "Webhook messages waiting to be stored", lambda: {(): INGEST_QUEUE.pending}
+))
+DUPLICATES = METRICS.register(Counter(
+    "hub_duplicate_messages_total", "Redelivered messages recognized by their idempotency key and not stored again"
+))
+METRICS.register(Gauge(
+    "hub_store_messages", "Messages held in memory", lambda: {(): len(MESSAGES)}
+))
+METRICS.register(Gauge(
+    "hub_store_bytes", "Estimated memory held by stored messages", lambda: {(): MESSAGES.stats()["bytes"]}
+))
+METRICS.register(Gauge(
+    "hub_store_conversations", "Conversations held in memory", lambda: {(): MESSAGES.stats()["conversations"]}
+))
+METRICS.register(Gauge(
+    "hub_store_last_seq", "Highest message seq assigned", lambda: {(): MESSAGES.last_seq}
+))
+METRICS.register(Gauge(
+    "hub_search_index_bytes",
+    "Estimated memory held by the full-text search index",
+    lambda: {(): MESSAGES.index.stats()["bytes"]} if MESSAGES.index is not None else {},
+))
+METRICS.register(Gauge(
+    "hub_evicted_messages_total",
+    "Messages evicted from memory by reason",
+    lambda: {(reason,): n for reason, n in MESSAGES.evicted.items()},
+    ("reason",),
+    kind="counter",
+))
+METRICS.register(SnapshotHistogram(
+    "hub_conversation_messages",
+    "Distribution of messages stored per conversation",
+    (1, 5, 10, 50, 100, 500, 1000, 5000, 10000),
+    lambda: MESSAGES.conversation_sizes(),
+))
+METRICS.register(Gauge(
+    "hub_stream_subscribers", "Open /messages/stream connections", lambda: {(): BROKER.subscriber_count()}
+))
+METRICS.register(Gauge(
+    "hub_active_pollers",
+    f"Conversations polled through /messages/by-phone in the last {POLLERS.window_s:.0f}s",
+    lambda: {(): POLLERS.count()},
+))
+METRICS.register(Gauge(
+    "hub_log_records_dropped_total",
+    "Log records dropped because the log queue was full",
+    lambda: {(): sum(getattr(h, "dropped", 0) for h in log.handlers)},
+    kind="counter",
+))
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware (no BaseHTTPMiddleware task/stream wrapping).
+    # The route label is the matched path template, which keeps it low-cardinality.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        responded = False
+
+        async def send_with_metrics(message):
+            nonlocal responded
+            if message["type"] == "http.response.start" and not responded:
+                responded = True
+                route = scope.get("route")
+                path = route.path if route is not None else "unmatched"
+                REQUEST_LATENCY.observe(time.perf_counter() - started, path)
+                REQUESTS.inc(path, scope["method"], str(message["status"]))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            if not responded:
+                route = scope.get("route")
+                REQUESTS.inc(route.path if route is not None else "unmatched", scope["method"], "500")
+
+
+app.add_middleware(MetricsMiddleware)
+
+
+class ReadPriorityMiddleware:
+    # Counts GET requests in READS until their response starts, so that bulk
+    # ingest can step aside for them (event streams only count until they open).
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+        READS.active += 1
+        counted = True
+
+        async def send_started(message):
+            nonlocal counted
+            if counted and message["type"] == "http.response.start":
+                counted = False
+                READS.active -= 1
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_started)
+        finally:
+            if counted:
+                READS.active -= 1
+
+
+app.add_middleware(ReadPriorityMiddleware)
+
+
+def load_messages() -> int:
+    # Rebuild the in-memory indexes from storage, skipping whatever retention
+    # would evict straight away.
+    started = time.perf_counter()
+    min_received = time.time() - MESSAGE_TTL_S if MESSAGE_TTL_S else 0.0
+    rows = STORAGE.replay(min_received, MAX_MESSAGES)
+    if STORAGE.durable and not STORAGE.shared and RECENT_KEYS.max_size:
+        rows = _replay_keys(rows)
+    count = MESSAGES.load(rows)
+    # Shared storage allocates the seqs itself
+    if not STORAGE.shared:
+        MESSAGES.continue_from(STORAGE.last_seq())
+    # The replayed messages are long-lived; keep later GC passes from rescanning them
+    gc.freeze()
+    log.info(
+        "messages replayed from storage",
+        extra={"backend": STORAGE_BACKEND, "count": count, "seconds": round(time.perf_counter() - started, 3)},
+    )
+    return count
+
+
+def _replay_keys(rows):
+    # sqlite mode: a redelivery must still be recognized after a restart. The
+    # content keys (chatId + timestamp + text) of replayed messages within the
+    # dedup window go back into RECENT_KEYS; Idempotency-Key headers are not
+    # stored, so those are not.
+    now = time.time()
+    cutoff = now - DEDUP_TTL_S if DEDUP_TTL_S else 0.0
+    for row in rows:
+        msg, received = row
+        if received >= cutoff and msg.get("timestamp"):
+            RECENT_KEYS.add(_idempotency_key(msg, None), msg["seq"], max(0.0, now - received))
+        yield row
+
+
+def sync_from_storage() -> int:
+    # Shared mode only: index and fan out whatever any worker (this one
+    # included) committed since our last seq. Called before every read so all
+    # workers answer from the same log, and periodically for live streams.
+    if not STORAGE.shared:
+        return 0
+    rows = STORAGE.changes(MESSAGES.last_seq)
+    for msg, received in rows:
+        MESSAGES.add(msg, received)
+        BROKER.publish(msg["patientPhone"], msg)
+    return len(rows)
+
+
+async def follow_storage() -> None:
+    while True:
+        await asyncio.sleep(SYNC_INTERVAL_S)
+        try:
+            sync_from_storage()
+        except Exception:
+            log.exception("failed to follow shared storage")
 
 class N8nMessage(BaseModel):
     chatId: str
@@ -16,21 +1110,531 @@ class N8nMessage(BaseModel):
     timestamp: str | None = None
 
 
+@app.get("/metrics")
+async def get_metrics():
+    sync_from_storage()
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/stats")
+async def get_stats():
+    sync_from_storage()
+    return {
+        "store": MESSAGES.stats(),
+        "epoch": EPOCH,
+        "subscribers": BROKER.subscriber_count(),
+        "dedupKeys": len(RECENT_KEYS),
+    }
+
+
+def _idempotency_key(msg: dict, header: Optional[str]) -> Optional[bytes]:
+    # The Idempotency-Key header if the sender set one, else chatId + timestamp
+    # + message text. Without a timestamp two identical texts in a chat may be
+    # two real messages ("ok"), so those are never taken for duplicates.
+    if header:
+        raw = "h\0" + header
+    elif msg["timestamp"]:
+        raw = "\0".join(("c", msg["chatId"], msg["timestamp"], msg["message"]))
+    else:
+        return None
+    return hashlib.blake2b(raw.encode(), digest_size=16).digest()
+
+
+async def ingest(msgs: List[dict], keys: Optional[List[Optional[bytes]]] = None) -> List[Tuple[int, bool]]:
+    # Deduplicate, then store, persist and fan out validated messages; returns
+    # (seq, duplicate) per message. A message whose idempotency key was seen
+    # recently (see RecentKeys) is not stored again and gets the seq of the
+    # first delivery. While the first delivery is still being stored, a
+    # redelivery waits for it, and is stored itself if that fails: it is never
+    # acknowledged without a seq. Raises a 429 HTTPException when the new
+    # messages are not admitted (see _admit); duplicates are not charged.
+    if keys is None or not RECENT_KEYS.max_size:
+        keys = [None] * len(msgs)
+    results: List[Optional[Tuple[int, bool]]] = [None] * len(msgs)
+    todo = list(range(len(msgs)))
+    while todo:
+        todo = await _ingest_round(msgs, keys, todo, results)
+    duplicates = sum(duplicate for _, duplicate in results)
+    if duplicates:
+        DUPLICATES.inc(amount=duplicates)
+    return results
+
+
+async def _ingest_round(msgs: List[dict], keys: List[Optional[bytes]], todo: List[int], results: list) -> List[int]:
+    # Stores the messages at the `todo` indexes that are not duplicates and
+    # fills in results; returns the indexes of redeliveries whose first
+    # delivery failed meanwhile, to be tried again. Keys are claimed (with a
+    # future) before the first await, so concurrent deliveries cannot both get in.
+    fresh: List[int] = []
+    claims: Dict[int, asyncio.Future] = {}
+    waiting: Dict[int, asyncio.Future] = {}
+    for i in todo:
+        key = keys[i]
+        if key is not None:
+            first = RECENT_KEYS.get(key)
+            if isinstance(first, asyncio.Future):
+                waiting[i] = first
+                continue
+            if first is not None:
+                results[i] = (first, True)
+                continue
+            claims[i] = asyncio.get_running_loop().create_future()
+            RECENT_KEYS.add(key, claims[i])
+        fresh.append(i)
+    try:
+        if fresh:
+            _admit([msgs[i] for i in fresh])
+            outcomes = await _store([msgs[i] for i in fresh], [keys[i] for i in fresh])
+            for i, outcome in zip(fresh, outcomes):
+                results[i] = outcome
+    finally:
+        # Keys of messages that were not stored (_store failed and took them
+        # back) are released so that a redelivery gets in.
+        for i, claim in claims.items():
+            seq = results[i][0] if results[i] is not None else None
+            if seq is None:
+                RECENT_KEYS.discard(keys[i])
+            else:
+                RECENT_KEYS.add(keys[i], seq)
+            claim.set_result(seq)
+
+    retry = []
+    for i, first in waiting.items():
+        seq = await first
+        if seq is None:
+            retry.append(i)
+        else:
+            results[i] = (seq, True)
+    return retry
+
+
+def _admit(msgs: List[dict]) -> None:
+    # 429 with Retry-After if the ingest queue is full or a tenant is over its rate
+    if INGEST_QUEUE.full(len(msgs)):
+        REJECTED.inc("queue", amount=len(msgs))
+        raise HTTPException(
+            status_code=429, detail="ingest queue is full", headers={"Retry-After": str(INGEST_QUEUE.retry_after())}
+        )
+    counts: Dict[str, int] = defaultdict(int)
+    for msg in msgs:
+        counts[msg["tenantPhone"]] += 1
+    wait = TENANT_BUCKETS.take(counts)
+    if wait:
+        REJECTED.inc("rate", amount=len(msgs))
+        raise HTTPException(
+            status_code=429, detail="tenant rate limit exceeded", headers={"Retry-After": str(math.ceil(wait))}
+        )
+
+
+async def _store(msgs: List[dict], keys: List[Optional[bytes]]) -> List[Tuple[int, bool]]:
+    # Hands the messages to INGEST_QUEUE and waits until they are stored and,
+    # with HUB_DURABLE_ACK, persisted. Returns (seq, duplicate) per message:
+    # shared storage recognizes redeliveries stored by the other workers.
+    received = time.time()
+    received_at = datetime.utcnow().isoformat()
+    # "ts": the message time as epoch ms, parsed here once for every reader
+    for msg in msgs:
+        msg["receivedAt"] = received_at
+        msg["ts"] = _epoch_ms(msg["timestamp"], received)
+    if STORAGE.shared:
+        persisted = await INGEST_QUEUE.submit(msgs, received, keys)
+        outcomes = await asyncio.wrap_future(persisted)
+        sync_from_storage()
+    else:
+        try:
+            persisted = await INGEST_QUEUE.submit(msgs, received, keys)
+            if DURABLE_ACK:
+                for future in persisted:
+                    await asyncio.wrap_future(future)
+        except Exception:
+            # Not stored: take the messages back out of memory so that a
+            # redelivery is stored (and persisted) again instead of acked as
+            # a duplicate of something that is not there. Stream subscribers
+            # may already have seen them.
+            MESSAGES.discard([msg for msg in msgs if "seq" in msg])
+            raise
+        outcomes = [(msg["seq"], False) for msg in msgs]
+    INGESTED.inc(amount=sum(not duplicate for _, duplicate in outcomes))
+    return outcomes
+
+
+async def _write(msgs: List[dict], received: float, keys: List[Optional[bytes]]):
+    # Runs on the ingest queue's task, one request at a time.
+    # Shared mode: storage assigns the seqs and skips redeliveries (by key), in
+    # one append; the messages reach the index (and the streams) by following
+    # the log, like those of the other workers. Returns the append's future.
+    # Otherwise the messages are stored in chunks of HUB_INGEST_CHUNK, each
+    # persisted as one storage append, and reads that are waiting are answered
+    # between chunks: they may see the first part of a large batch, but seqs
+    # stay in order. Returns the storage futures to wait for.
+    if STORAGE.shared:
+        return STORAGE.append([(msg, received) for msg in msgs], keys)
+    step = INGEST_CHUNK or len(msgs)
+    persisted = []
+    for start in range(0, len(msgs), step):
+        if start:
+            await READS.yield_to_reads()
+        chunk = msgs[start:start + step]
+        for msg in chunk:
+            MESSAGES.add(msg, received)
+        future = STORAGE.append([(msg, received) for msg in chunk])
+        if future is not None and future not in persisted:
+            persisted.append(future)
+        for msg in chunk:
+            BROKER.publish(msg["patientPhone"], msg)
+    return persisted
+
+
+INGEST_QUEUE = IngestQueue(_write)
+
+
+def reset_state() -> None:
+    # Empty in-memory state with the configured limits, for running several
+    # load scenarios in one process (bench_load.py). Storage is left alone.
+    global MESSAGES, BROKER, POLLERS, RECENT_KEYS, TENANT_BUCKETS, INGEST_QUEUE
+    INGEST_QUEUE.close()
+    MESSAGES = MessageStore()
+    BROKER = Broker()
+    POLLERS = ActivePollers()
+    RECENT_KEYS = RecentKeys()
+    TENANT_BUCKETS = TokenBuckets()
+    INGEST_QUEUE = IngestQueue(_write)
+
+
+# Redeliveries (n8n retries on timeouts) are acknowledged without storing the
+# message again: {"ok": true, "seq": <seq of the first delivery>, "duplicate": true}.
+# They are recognized by the Idempotency-Key header, or else by chatId +
+# timestamp + message text.
 @app.post("/webhook/n8n")
-async def receive_from_n8n(payload: N8nMessage):
+async def receive_from_n8n(payload: N8nMessage, idempotency_key: Optional[str] = Header(None)):
     msg = payload.dict()
-    msg["receivedAt"] = datetime.utcnow().isoformat()
+    (seq, duplicate), = await ingest([msg], [_idempotency_key(msg, idempotency_key)])
+    if duplicate:
+        message_log.info("duplicate message", extra={"seq": seq, "chatId": msg["chatId"]})
+        return {"ok": True, "seq": seq, "duplicate": True}
+    # Identifiers only: formatting the whole message (and its text) is not worth it per request
+    message_log.info(
+        "message received",
+        extra={"seq": seq, "chatId": msg["chatId"], "patientPhone": msg["patientPhone"], "chars": len(msg["message"])},
+    )
+
+    return {"ok": True, "seq": seq}
+
+
+INVALID_JSON = object()
+
+
+def _parse_batch(body: bytes, content_type: str) -> List[Any]:
+    # NDJSON (one message per line) or a JSON array / {"messages": [...]}.
+    # NDJSON lines that are not valid JSON are returned as INVALID_JSON and
+    # reported per item instead of failing the whole batch.
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        items = []
+        for line in body.splitlines():
+            if line.strip():
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    items.append(INVALID_JSON)
+        return items
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="body is not valid JSON")
+    if isinstance(data, dict):
+        data = data.get("messages")
+    if not isinstance(data, list):
+        raise HTTPException(status_code=400, detail="expected a JSON array of messages")
+    return data
+
+
+# Per item, the Idempotency-Key header of a batch becomes "<key>:<index>"
+@app.post("/webhook/n8n/batch")
+async def receive_batch_from_n8n(request: Request, idempotency_key: Optional[str] = Header(None)):
+    items = _parse_batch(await request.body(), request.headers.get("content-type", ""))
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"at most {BATCH_MAX_ITEMS} messages per batch")
+
+    results: List[dict] = []
+    valid: List[dict] = []
+    keys: List[Optional[bytes]] = []
+    for index, item in enumerate(items):
+        if item is INVALID_JSON:
+            results.append({"index": index, "ok": False, "error": "invalid JSON"})
+            continue
+        if not isinstance(item, dict):
+            results.append({"index": index, "ok": False, "error": "not a JSON object"})
+            continue
+        try:
+            msg = N8nMessage(**item).dict()
+        except ValidationError as exc:
+            errors = [{"loc": list(e["loc"]), "msg": e["msg"]} for e in exc.errors()]
+            results.append({"index": index, "ok": False, "error": errors})
+            continue
+        results.append({"index": index, "ok": True})
+        valid.append(msg)
+        keys.append(_idempotency_key(msg, idempotency_key and f"{idempotency_key}:{index}"))
+
+    outcomes = iter(await ingest(valid, keys)) if valid else iter(())
+    duplicates = 0
+    for result in results:
+        if result["ok"]:
+            result["seq"], duplicate = next(outcomes)
+            if duplicate:
+                result["duplicate"] = True
+                duplicates += 1
+    log.info(
+        "batch received",
+        extra={"accepted": len(valid), "rejected": len(results) - len(valid), "duplicates": duplicates},
+    )
+
+    return {
+        "ok": len(valid) == len(results),
+        "accepted": len(valid),
+        "rejected": len(results) - len(valid),
+        "results": results,
+    }
+
+
+def _dumps(body: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(body)
+    return json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode()
+
 
-    MESSAGES.append(msg)
-    print("📩 Message received from n8n:", msg)
+def _accepted_encodings(header: str) -> Set[str]:
+    # Content codings of an Accept-Encoding header, minus those refused with q=0
+    encodings = set()
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        key, _, value = params.strip().partition("=")
+        try:
+            refused = key.strip() == "q" and float(value) == 0
+        except ValueError:
+            refused = False
+        if not refused:
+            encodings.add(name.strip().lower())
+    return encodings
 
-    return {"ok": True}
 
+def _json_response(request: Request, body: Any) -> Response:
+    # Encodes directly (no jsonable_encoder pass over every message) and
+    # compresses with br or gzip, as negotiated through Accept-Encoding.
+    data = _dumps(body)
+    headers = {"Vary": "Accept-Encoding"}
+    if len(data) >= COMPRESS_MIN_BYTES:
+        accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+        if brotli is not None and "br" in accepted:
+            data = brotli.compress(data, quality=4)
+            headers["Content-Encoding"] = "br"
+        elif "gzip" in accepted:
+            data = gzip.compress(data, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+    return Response(data, media_type="application/json", headers=headers)
 
+
+def _project(messages: List[dict], fields: Optional[str]) -> List[dict]:
+    # Only the requested fields of each message; "seq" is always kept (it is the cursor)
+    if not fields:
+        return messages
+    keys = ["seq"] + [f for f in (f.strip() for f in fields.split(",")) if f and f != "seq"]
+    return [{k: m[k] for k in keys if k in m} for m in messages]
+
+
+def _page(request: Request, result, fields: Optional[str]) -> Response:
+    messages, cursor, has_more = result
+    return _json_response(request, {
+        "messages": _project(messages, fields),
+        "nextCursor": cursor,
+        "prevCursor": messages[0]["seq"] if messages else None,
+        "hasMore": has_more,
+        "epoch": EPOCH,
+    })
+
+
+def _since(since: int, after: Optional[int], epoch: Optional[int]) -> int:
+    # A cursor from another epoch says nothing about the current seqs: start over
+    if epoch is not None and epoch != EPOCH:
+        return 0
+    return max(since, after or 0)
+
+
+# `since` (alias `after`) is the nextCursor of the previous response (0 = from
+# the beginning); only messages with a greater seq are returned, at most
+# `limit` of them. Every response carries the hub's `epoch`: pass it back with
+# the cursor, and a cursor from an earlier epoch (the hub restarted and seqs
+# started over) is taken as 0, so the client catches up from the beginning
+# instead of waiting for new seqs to pass its old cursor. `before` pages backwards instead: the newest `limit`
+# messages with a smaller seq (pass the prevCursor of the previous page;
+# hasMore then means older messages remain).
+# `fromTs`/`toTs` (epoch ms, to exclusive) restrict them to a range of message
+# time, the "ts" field of every message. `fields` (comma-separated, e.g.
+# "message,ts") trims each message to those fields plus "seq".
+# Responses are compressed (br/gzip) when the client accepts it.
 @app.get("/messages/by-phone")
-async def get_messages(patientPhone: str):
-    results = [
-        m for m in MESSAGES
-        if m["patientPhone"] == patientPhone
-    ]
-    return {"messages": results}
+async def get_messages(
+    request: Request,
+    patientPhone: str,
+    since: int = Query(0, ge=0),
+    after: Optional[int] = Query(None, ge=0),
+    before: Optional[int] = Query(None, ge=1),
+    limit: int = Query(PAGE_LIMIT, ge=1, le=PAGE_LIMIT_MAX),
+    fromTs: Optional[int] = None,
+    toTs: Optional[int] = None,
+    fields: Optional[str] = None,
+    epoch: Optional[int] = None,
+):
+    sync_from_storage()
+    POLLERS.touch(patientPhone)
+    result = MESSAGES.by_patient(patientPhone, _since(since, after, epoch), limit, fromTs, toTs, before)
+    return _page(request, result, fields)
+
+
+# Deltas for many conversations in one request, for dashboards watching many
+# patients: repeat patientPhone (up to HUB_MAX_PHONES_PER_QUERY). One cursor
+# covers them all; messages come back grouped by patientPhone, and only the
+# conversations with new messages appear.
+@app.get("/messages/by-phones")
+async def get_messages_by_phones(
+    request: Request,
+    patientPhone: List[str] = Query(...),
+    since: int = Query(0, ge=0),
+    limit: int = Query(PAGE_LIMIT, ge=1, le=PAGE_LIMIT_MAX),
+    fromTs: Optional[int] = None,
+    toTs: Optional[int] = None,
+    fields: Optional[str] = None,
+    epoch: Optional[int] = None,
+):
+    if len(patientPhone) > MAX_PHONES_PER_QUERY:
+        raise HTTPException(status_code=400, detail=f"at most {MAX_PHONES_PER_QUERY} patientPhone values")
+    sync_from_storage()
+    for phone in patientPhone:
+        POLLERS.touch(phone)
+    messages, cursor, has_more = MESSAGES.by_patients(patientPhone, _since(since, None, epoch), limit, fromTs, toTs)
+    conversations: Dict[str, List[dict]] = {}
+    for msg, projected in zip(messages, _project(messages, fields)):
+        conversations.setdefault(msg["patientPhone"], []).append(projected)
+    return _json_response(
+        request, {"conversations": conversations, "nextCursor": cursor, "hasMore": has_more, "epoch": EPOCH}
+    )
+
+
+@app.get("/messages/by-tenant")
+async def get_messages_by_tenant(
+    request: Request,
+    tenantPhone: str,
+    since: int = Query(0, ge=0),
+    after: Optional[int] = Query(None, ge=0),
+    before: Optional[int] = Query(None, ge=1),
+    limit: int = Query(PAGE_LIMIT, ge=1, le=PAGE_LIMIT_MAX),
+    fromTs: Optional[int] = None,
+    toTs: Optional[int] = None,
+    fields: Optional[str] = None,
+    epoch: Optional[int] = None,
+):
+    sync_from_storage()
+    result = MESSAGES.by_tenant(tenantPhone, _since(since, after, epoch), limit, fromTs, toTs, before)
+    return _page(request, result, fields)
+
+
+@app.get("/messages/by-chat")
+async def get_messages_by_chat(
+    request: Request,
+    chatId: str,
+    since: int = Query(0, ge=0),
+    after: Optional[int] = Query(None, ge=0),
+    before: Optional[int] = Query(None, ge=1),
+    limit: int = Query(PAGE_LIMIT, ge=1, le=PAGE_LIMIT_MAX),
+    fromTs: Optional[int] = None,
+    toTs: Optional[int] = None,
+    fields: Optional[str] = None,
+    epoch: Optional[int] = None,
+):
+    sync_from_storage()
+    result = MESSAGES.by_chat(chatId, _since(since, after, epoch), limit, fromTs, toTs, before)
+    return _page(request, result, fields)
+
+
+# Full-text search over message text. `q` holds the terms that must all occur
+# (case-insensitive, whole words); end a term with "*" to match it as a prefix,
+# e.g. "refill pharm*". Optional filters: patientPhone, tenantPhone and the
+# fromTs/toTs message time range. Results are newest first: the page holds the
+# newest `limit` matches and hasMore means older ones remain; pass the
+# prevCursor as `before` for the next page.
+@app.get("/messages/search")
+async def search_messages(
+    request: Request,
+    q: str,
+    patientPhone: Optional[str] = None,
+    tenantPhone: Optional[str] = None,
+    since: int = Query(0, ge=0),
+    before: Optional[int] = Query(None, ge=1),
+    limit: int = Query(SEARCH_LIMIT, ge=1, le=PAGE_LIMIT_MAX),
+    fromTs: Optional[int] = None,
+    toTs: Optional[int] = None,
+    fields: Optional[str] = None,
+):
+    if MESSAGES.index is None:
+        raise HTTPException(status_code=503, detail="search index is disabled (HUB_SEARCH_INDEX=0)")
+    sync_from_storage()
+    try:
+        result = MESSAGES.search(q, patientPhone, tenantPhone, since, limit, fromTs, toTs, before)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return _page(request, result, fields)
+
+
+def _sse_event(msg: dict) -> str:
+    # "<epoch>-<seq>" is the SSE event id, so a reconnecting EventSource resumes
+    # from Last-Event-ID without gaps or duplicates (and from the beginning
+    # once the hub is in a new epoch).
+    return f"id: {EPOCH}-{msg['seq']}\ndata: {json.dumps(msg)}\n\n"
+
+
+@app.get("/messages/stream")
+async def stream_messages(
+    request: Request,
+    patientPhone: str,
+    since: int = Query(0, ge=0),
+    epoch: Optional[int] = None,
+    last_event_id: Optional[str] = Header(None),
+):
+    since = _since(since, None, epoch)
+    event_epoch, _, event_seq = (last_event_id or "").partition("-")
+    if event_epoch == str(EPOCH) and event_seq.isascii() and event_seq.isdigit():
+        since = max(since, int(event_seq))
+    sync_from_storage()
+
+    async def events():
+        # Subscribe before replaying so nothing published in between is missed;
+        # the seq check drops whatever the replay already sent.
+        sub = BROKER.subscribe(patientPhone)
+        cursor = since
+        catch_up = True
+        try:
+            yield "retry: 1000\n\n"
+            while True:
+                if catch_up or sub.overflowed:
+                    sub.reset()
+                    backlog, cursor, _ = MESSAGES.by_patient(patientPhone, cursor)
+                    for msg in backlog:
+                        yield _sse_event(msg)
+                    catch_up = False
+                try:
+                    msg = await asyncio.wait_for(sub.queue.get(), STREAM_HEARTBEAT_S)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keep-alive\n\n"
+                    continue
+                if msg["seq"] > cursor:
+                    cursor = msg["seq"]
+                    yield _sse_event(msg)
+        finally:
+            BROKER.unsubscribe(patientPhone, sub)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,229 @@
+import heapq
+import re
+import sys
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Inverted index over the text of the messages held by the hub's MessageStore,
+# maintained incrementally: the store adds every message as it is ingested and
+# removes it again when retention drops it.
+#
+# Each term maps to a compact array of the seqs of the messages containing it.
+# Messages are indexed in seq order, so the arrays are sorted by construction:
+# appending is O(1), membership is a bisect, and results come out newest first
+# by walking an array backwards. Removal is lazy: the message is forgotten
+# right away (queries skip its seq), its postings are counted dead a few
+# messages per add() (REMOVE_BATCH), from the terms kept when it was indexed,
+# and a term's array is compacted once more than half of it is dead. So
+# evicting a whole conversation costs O(1) per message on the ingest that does
+# it, and removal is amortized O(1) per posting.
+#
+# Prefix queries expand over a sorted vocabulary. New terms go to a small
+# sorted list that is merged into the main one every VOCAB_MERGE_AT terms, so
+# adding a term never shifts the whole vocabulary.
+
+TOKEN_RE = re.compile(r"\w+")
+QUERY_RE = re.compile(r"(\w+)(\*?)")
+MAX_TERM_CHARS = 32  # longer tokens are indexed (and queried) by their first 32 characters
+MAX_QUERY_TERMS = 8
+MIN_PREFIX_CHARS = 2
+PREFIX_MAX_TERMS = 1000  # a prefix matching more terms than this is rejected as too broad
+VOCAB_MERGE_AT = 4096
+COMPACT_MIN_POSTINGS = 64
+REMOVE_BATCH = 16  # removed messages whose postings are counted dead per add()
+
+# Rough resident sizes for nbytes: a posting (array entry, and its slot in the
+# message's term tuple), a term (dict entries in the postings and dead-count
+# maps, str and array headers, vocabulary slot), and a document (the seq ->
+# (message, *terms) entry; the message itself is the store's)
+POSTING_BYTES = 16
+TERM_OVERHEAD_BYTES = 220
+DOC_OVERHEAD_BYTES = 120
+
+# A query clause: the posting arrays of one term, or of every term matching a prefix
+Clause = List[array]
+
+
+def terms_of(text: str) -> Iterable[str]:
+    # Interned: the term tuples of the indexed messages share one copy of each term
+    return {sys.intern(t[:MAX_TERM_CHARS]) for t in TOKEN_RE.findall(text.lower())}
+
+
+def _contains(postings: array, seq: int) -> bool:
+    i = bisect_left(postings, seq)
+    return i < len(postings) and postings[i] == seq
+
+
+def _descending(postings: array, since: int, before: Optional[int]) -> Iterator[int]:
+    # Seqs with since < seq < before, newest first
+    lo = bisect_right(postings, since)
+    hi = bisect_left(postings, before) if before is not None else len(postings)
+    return (postings[i] for i in range(hi - 1, lo - 1, -1))
+
+
+class SearchIndex:
+    def __init__(self, field: str = "message"):
+        self.field = field
+        self._postings: Dict[str, array] = {}
+        self._dead: Dict[str, int] = {}
+        # seq -> (message, *its terms), one flat tuple per message; the
+        # (seq, terms) of removed messages wait in _removed
+        self._docs: Dict[int, tuple] = {}
+        self._removed: Deque[Tuple[int, Tuple[str, ...]]] = deque()
+        self._vocab: List[str] = []
+        self._recent: List[str] = []
+        self._posting_count = 0
+        self._live_postings = 0
+        self._term_chars = 0
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    @property
+    def nbytes(self) -> int:
+        # Rough resident size; drops as soon as messages are removed, before
+        # their postings are cleaned up
+        return (
+            self._live_postings * POSTING_BYTES
+            + len(self._postings) * TERM_OVERHEAD_BYTES
+            + self._term_chars
+            + len(self._docs) * DOC_OVERHEAD_BYTES
+        )
+
+    def stats(self) -> dict:
+        return {
+            "documents": len(self._docs),
+            "terms": len(self._postings),
+            "postings": self._posting_count,
+            "pendingRemovals": len(self._removed),
+            "bytes": self.nbytes,
+        }
+
+    def add(self, msg: dict) -> None:
+        # Messages must be added in seq order
+        seq = msg["seq"]
+        terms = terms_of(msg.get(self.field) or "")
+        self._docs[seq] = (msg, *terms)
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = array("q")
+                self._term_chars += len(term)
+                insort(self._recent, term)
+                if len(self._recent) >= VOCAB_MERGE_AT:
+                    self._merge_vocab()
+            postings.append(seq)
+        self._posting_count += len(terms)
+        self._live_postings += len(terms)
+        if self._removed:
+            self._sweep(REMOVE_BATCH)
+
+    def remove(self, msgs: Iterable[dict]) -> None:
+        for msg in msgs:
+            doc = self._docs.pop(msg["seq"], None)
+            if doc is not None:
+                self._live_postings -= len(doc) - 1
+                self._removed.append((msg["seq"], doc[1:]))
+
+    def _sweep(self, budget: int) -> None:
+        # Counts the postings of up to `budget` removed messages dead
+        for _ in range(min(budget, len(self._removed))):
+            seq, terms = self._removed.popleft()
+            for term in terms:
+                postings = self._postings.get(term)
+                # Gone with the term, or compacted away since the removal
+                if postings is None or not _contains(postings, seq):
+                    continue
+                dead = self._dead.get(term, 0) + 1
+                if dead == len(postings):
+                    del self._postings[term]
+                    self._dead.pop(term, None)
+                    self._posting_count -= dead
+                    self._term_chars -= len(term)
+                elif dead * 2 > len(postings) and len(postings) >= COMPACT_MIN_POSTINGS:
+                    # Also drops the postings of removed messages not swept yet
+                    live = array("q", (s for s in postings if s in self._docs))
+                    self._dead.pop(term, None)
+                    self._posting_count -= len(postings) - len(live)
+                    if live:
+                        self._postings[term] = live
+                    else:
+                        del self._postings[term]
+                        self._term_chars -= len(term)
+                else:
+                    self._dead[term] = dead
+
+    def clauses(self, query: str) -> Optional[List[Clause]]:
+        # One clause per query term, all of which must match ("refill rx*");
+        # a trailing "*" makes a term a prefix. None if some term matches
+        # nothing. Raises ValueError for queries that cannot be answered.
+        parsed = QUERY_RE.findall(query.lower())
+        if not parsed:
+            raise ValueError("query has no searchable terms")
+        if len(parsed) > MAX_QUERY_TERMS:
+            raise ValueError(f"at most {MAX_QUERY_TERMS} query terms")
+        clauses = []
+        for term, star in dict.fromkeys(parsed):
+            term = term[:MAX_TERM_CHARS]
+            if star:
+                clause = [self._postings[t] for t in self._expand(term)]
+            else:
+                postings = self._postings.get(term)
+                clause = [postings] if postings is not None else []
+            if not clause:
+                return None
+            clauses.append(clause)
+        # Smallest first: it drives the walk, the others are only probed
+        clauses.sort(key=self.size)
+        return clauses
+
+    @staticmethod
+    def size(clause: Clause) -> int:
+        return sum(len(p) for p in clause)
+
+    @staticmethod
+    def matches(clauses: List[Clause], seq: int) -> bool:
+        return all(any(_contains(p, seq) for p in clause) for clause in clauses)
+
+    def candidates(self, clauses: List[Clause], since: int = 0, before: Optional[int] = None) -> Iterator[dict]:
+        # Live messages matching every clause with since < seq < before, newest first
+        driver, rest = clauses[0], clauses[1:]
+        if len(driver) == 1:
+            seqs = _descending(driver[0], since, before)
+        else:
+            seqs = heapq.merge(*(_descending(p, since, before) for p in driver), reverse=True)
+        last = None
+        for seq in seqs:
+            # A message containing several terms of a prefix comes up once per term
+            if seq == last:
+                continue
+            last = seq
+            doc = self._docs.get(seq)
+            if doc is not None and (not rest or self.matches(rest, seq)):
+                yield doc[0]
+
+    def _expand(self, prefix: str) -> List[str]:
+        if len(prefix) < MIN_PREFIX_CHARS:
+            raise ValueError(f"prefixes need at least {MIN_PREFIX_CHARS} characters")
+        found = set()
+        for vocab in (self._vocab, self._recent):
+            i = bisect_left(vocab, prefix)
+            while i < len(vocab) and vocab[i].startswith(prefix):
+                if vocab[i] in self._postings:
+                    found.add(vocab[i])
+                    if len(found) > PREFIX_MAX_TERMS:
+                        raise ValueError(f"prefix {prefix!r}* matches too many terms")
+                i += 1
+        return sorted(found)
+
+    def _merge_vocab(self) -> None:
+        # Also drops terms whose postings are gone, and the duplicates of terms
+        # that were removed and indexed again
+        vocab = []
+        for term in heapq.merge(self._vocab, self._recent):
+            if term in self._postings and (not vocab or vocab[-1] != term):
+                vocab.append(term)
+        self._vocab = vocab
+        self._recent = []
@@ -0,0 +1,69 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Tuple
+
+# Outbound sends of the consoles, off the script thread. A console submits a
+# send under the id of its local "sending" message and returns immediately;
+# worker threads deliver it, retrying failures with exponential backoff, and
+# later reruns collect the outcome to flip the message to sent/failed.
+#
+# One queue is shared by every session of the server process (created via
+# st.cache_resource). Workers never touch st.session_state, which belongs to
+# the script thread: outcomes wait here until the owning session collects them.
+
+RESULT_TTL_S = 600  # outcomes nobody collected (closed tab) are dropped after this
+
+
+class SendQueue:
+    def __init__(
+        self,
+        send: Callable[..., Dict[str, Any]],
+        workers: int = 4,
+        retries: int = 3,
+        backoff: float = 1.0,
+    ):
+        # `send` returns {"ok": bool, ...}; a failure is retried unless it
+        # says {"retry": False} (e.g. the API rejected the request, or it may
+        # have been delivered). An exception raised by `send` is not retried.
+        self._send = send
+        self.retries = retries
+        self.backoff = backoff
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="console-send")
+        self._lock = threading.Lock()
+        self._done: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+    def submit(self, job_id: str, *args: Any) -> None:
+        self._prune()
+        self._executor.submit(self._run, job_id, args)
+
+    def collect(self, job_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        # Outcomes of the finished jobs among `job_ids`, removed from the queue
+        out = {}
+        with self._lock:
+            for job_id in job_ids:
+                entry = self._done.pop(job_id, None)
+                if entry is not None:
+                    out[job_id] = entry[1]
+        return out
+
+    def _run(self, job_id: str, args: tuple) -> None:
+        attempt = 0
+        while True:
+            try:
+                result = self._send(*args)
+            except Exception as exc:
+                result = {"ok": False, "resp": None, "error": str(exc), "retry": False}
+            if result.get("ok") or result.get("retry") is False or attempt >= self.retries:
+                break
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+        result["attempts"] = attempt + 1
+        with self._lock:
+            self._done[job_id] = (time.monotonic(), result)
+
+    def _prune(self) -> None:
+        cutoff = time.monotonic() - RESULT_TTL_S
+        with self._lock:
+            for job_id in [j for j, (done, _) in self._done.items() if done < cutoff]:
+                del self._done[job_id]
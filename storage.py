@@ -0,0 +1,434 @@
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Durable side of the message hub. The in-memory MessageStore in main.py stays
+# the query index; a backend persists every ingested message and replays them
+# at startup so the indexes can be rebuilt after a restart.
+
+# A row is (message, receive time as epoch seconds)
+Row = Tuple[dict, float]
+# Idempotency key of a row (a digest), if it has one
+Key = Optional[bytes]
+
+log = logging.getLogger("hub.storage")
+
+
+class MemoryBackend:
+    # Nothing is persisted: messages live only as long as the process, and
+    # seqs start over with every process (a new epoch).
+    durable = False
+    shared = False
+
+    def __init__(self):
+        self.epoch = int(time.time() * 1000)
+
+    def last_seq(self) -> int:
+        return 0
+
+    def append(self, rows: List[Row], keys: Optional[List[Key]] = None) -> Optional[Future]:
+        return None
+
+    def replay(self, min_received: float = 0.0, max_rows: int = 0) -> Iterator[Row]:
+        return iter(())
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteBackend:
+    # Append-only segmented log kept in SQLite (WAL mode).
+    #
+    # A single writer thread takes everything that piled up while the previous
+    # transaction was committing and writes it as one segment: one row holding
+    # the pickled batch (group commit). append() returns the future of the
+    # batch the rows landed in, which resolves once it is committed; one future
+    # per batch rather than per message keeps the ingest path cheap.
+    #
+    # Under light traffic segments are small, so the trailing run of small
+    # segments is periodically merged into one. Replay then only unpickles a
+    # few large blobs instead of decoding a row (and every column) per message.
+    #
+    # A meta table keeps the highest seq written, which outlives pruning, so
+    # seqs keep increasing across restarts even if every message expired; the
+    # epoch (creation time of the database, epoch ms) only changes with a new
+    # database, i.e. whenever seqs do start over.
+    durable = True
+    shared = False
+
+    def __init__(
+        self,
+        path: str,
+        synchronous: str = "NORMAL",
+        ttl_s: float = 0.0,
+        prune_interval_s: float = 60.0,
+        segment_target: int = 4096,
+        compact_every: int = 256,
+    ):
+        self.path = path
+        self.synchronous = synchronous
+        self.ttl_s = ttl_s
+        self.prune_interval_s = prune_interval_s
+        self.segment_target = segment_target
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._rows: List[Row] = []
+        self._keys: List[Key] = []
+        self._future: Future = Future()
+        self._closed = False
+
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS segments ("
+                " first_seq INTEGER PRIMARY KEY,"
+                " last_seq INTEGER NOT NULL,"
+                " max_received REAL NOT NULL,"
+                " count INTEGER NOT NULL,"
+                " data BLOB NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS segments_last_seq ON segments (last_seq)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute(
+                "INSERT OR IGNORE INTO meta VALUES ('last_seq', (SELECT COALESCE(MAX(last_seq), 0) FROM segments))"
+            )
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('epoch', ?)", (int(time.time() * 1000),))
+            self._init_schema(conn)
+        self.epoch = conn.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+        # Segments from here on are below segment_target and get merged
+        self._compact_from = conn.execute(
+            "SELECT COALESCE(MAX(last_seq), 0) + 1 FROM segments WHERE count >= ?",
+            (segment_target,),
+        ).fetchone()[0]
+        conn.close()
+
+        self._writer = threading.Thread(target=self._run, name="hub-sqlite-writer", daemon=True)
+        self._writer.start()
+
+    def _init_schema(self, conn: sqlite3.Connection) -> None:
+        pass
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        return conn
+
+    def append(self, rows: List[Row], keys: Optional[List[Key]] = None) -> Future:
+        return self._enqueue(rows, keys)[0]
+
+    def _enqueue(self, rows: List[Row], keys: Optional[List[Key]]) -> Tuple[Future, int]:
+        # Returns the batch future and the position of `rows` in the batch.
+        # `keys` are the rows' idempotency keys, for backends that deduplicate.
+        with self._lock:
+            start = len(self._rows)
+            self._rows.extend(rows)
+            self._keys.extend(keys if keys is not None else [None] * len(rows))
+            fut = self._future
+        # The writer clears the event before taking the buffer, so skipping
+        # set() here can never strand rows.
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+        return fut, start
+
+    @staticmethod
+    def _segment(rows: List[Row]) -> tuple:
+        return (
+            rows[0][0]["seq"],
+            rows[-1][0]["seq"],
+            max(received for _, received in rows),
+            len(rows),
+            pickle.dumps(rows, pickle.HIGHEST_PROTOCOL),
+        )
+
+    def _run(self) -> None:
+        conn = self._connect()
+        last_prune = time.time()
+        written = 0
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            with self._lock:
+                rows, self._rows = self._rows, []
+                keys, self._keys = self._keys, []
+                fut, self._future = self._future, Future()
+                closed = self._closed
+
+            if rows:
+                try:
+                    result = self._write(conn, rows, keys)
+                except Exception as exc:
+                    fut.set_exception(exc)
+                else:
+                    fut.set_result(result)
+                    written += 1
+            else:
+                fut.set_result(0)
+
+            # Housekeeping must never take the writer down with it
+            try:
+                if written >= self.compact_every or (closed and written):
+                    written = 0
+                    self._compact(conn)
+                if time.time() - last_prune > self.prune_interval_s:
+                    last_prune = time.time()
+                    with conn:
+                        self._prune(conn, last_prune)
+            except Exception:
+                log.exception("storage housekeeping failed")
+            if closed:
+                break
+        conn.close()
+
+    def last_seq(self) -> int:
+        # Highest seq ever written, including messages pruned since
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT value FROM meta WHERE key = 'last_seq'").fetchone()[0]
+        finally:
+            conn.close()
+
+    def _write(self, conn: sqlite3.Connection, rows: List[Row], keys: List[Key]) -> Any:
+        # Returns the result of the batch future
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?)", self._segment(rows))
+            conn.execute(
+                "UPDATE meta SET value = MAX(value, ?) WHERE key = 'last_seq'", (rows[-1][0]["seq"],)
+            )
+        return len(rows)
+
+    def _prune(self, conn: sqlite3.Connection, now: float) -> None:
+        if self.ttl_s:
+            conn.execute("DELETE FROM segments WHERE max_received < ?", (now - self.ttl_s,))
+
+    def _compact(self, conn: sqlite3.Connection) -> None:
+        # Merge runs of consecutive small segments, each up to segment_target
+        # messages. Segments that are already large are left alone, so the
+        # cost per message stays bounded. Runs in an IMMEDIATE transaction so
+        # that it cannot interleave with another process's writer.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._merge_segments(conn)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def _merge_segments(self, conn: sqlite3.Connection) -> None:
+        segments = conn.execute(
+            "SELECT first_seq, count FROM segments WHERE first_seq >= ? ORDER BY first_seq",
+            (self._compact_from,),
+        ).fetchall()
+        if not segments:
+            return
+        runs: List[List[int]] = []
+        run: List[int] = []
+        total = 0
+        for first_seq, count in segments:
+            if count >= self.segment_target:
+                runs.append(run)
+                run, total = [], 0
+                continue
+            run.append(first_seq)
+            total += count
+            if total >= self.segment_target:
+                runs.append(run)
+                run, total = [], 0
+        runs.append(run)
+        tail = run
+
+        for run in runs:
+            if len(run) < 2:
+                continue
+            rows: List[Row] = []
+            for (data,) in conn.execute(
+                "SELECT data FROM segments WHERE first_seq >= ? AND first_seq <= ? ORDER BY first_seq",
+                (run[0], run[-1]),
+            ):
+                rows.extend(pickle.loads(data))
+            conn.execute("DELETE FROM segments WHERE first_seq >= ? AND first_seq <= ?", (run[0], run[-1]))
+            conn.execute("INSERT INTO segments VALUES (?, ?, ?, ?, ?)", self._segment(rows))
+        # The last run is still below segment_target and will grow
+        self._compact_from = tail[0] if tail else segments[-1][0] + 1
+
+    def replay(self, min_received: float = 0.0, max_rows: int = 0) -> Iterator[Row]:
+        # Rows in seq order. With max_rows, segments older than the newest
+        # max_rows messages are skipped (whole segments only; the store applies
+        # the exact ceiling when loading).
+        conn = self._connect()
+        try:
+            first_seq = 0
+            if max_rows:
+                total = 0
+                for seq, count in conn.execute("SELECT first_seq, count FROM segments ORDER BY first_seq DESC"):
+                    total += count
+                    if total >= max_rows:
+                        first_seq = seq
+                        break
+            segments = conn.execute(
+                "SELECT data FROM segments WHERE first_seq >= ? AND max_received >= ? ORDER BY first_seq",
+                (first_seq, min_received),
+            )
+            for (data,) in segments:
+                for row in pickle.loads(data):
+                    if row[1] >= min_received:
+                        yield row
+        finally:
+            conn.close()
+
+    def close(self) -> None:
+        # Flushes everything buffered so far, then stops the writer
+        with self._lock:
+            self._closed = True
+        self._wakeup.set()
+        self._writer.join()
+
+
+class SharedSQLiteBackend(SQLiteBackend):
+    # The same log, shared by several hub processes on one host (uvicorn
+    # --workers N). The database is the source of truth for ordering: seqs are
+    # allocated from the meta counter in the same IMMEDIATE transaction that
+    # writes the segment, so commit order equals seq order across processes.
+    #
+    # Each process keeps its own in-memory index and follows the log with
+    # changes(); PRAGMA data_version tells it cheaply whether any connection
+    # (its own writer included) committed since the last look, so an idle
+    # check costs one pragma and no reads.
+    #
+    # Ingest is idempotent across processes: the keys of recently written rows
+    # are kept in the dedup_keys table (bounded by count and age, like the
+    # hub's in-process window) and checked in the transaction that allocates
+    # the seqs. A redelivery is therefore recognized whichever worker stored
+    # the first delivery, and even after a restart.
+    shared = True
+
+    def __init__(self, path: str, dedup_window: int = 0, dedup_ttl_s: float = 0.0, **kwargs):
+        self.dedup_window = dedup_window
+        self.dedup_ttl_s = dedup_ttl_s
+        super().__init__(path, **kwargs)
+        self._reader: Optional[sqlite3.Connection] = None
+        self._data_version: Optional[int] = None
+
+    def _init_schema(self, conn: sqlite3.Connection) -> None:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS dedup_keys ("
+            " key BLOB PRIMARY KEY,"
+            " seq INTEGER NOT NULL,"
+            " added REAL NOT NULL) WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS dedup_keys_added ON dedup_keys (added)")
+
+    def append(self, rows: List[Row], keys: Optional[List[Key]] = None) -> Future:
+        # Resolves to (seq, duplicate) for each of `rows`: a row whose key was
+        # written before is skipped and gets the seq of the first delivery
+        batch, start = self._enqueue(rows, keys)
+        fut: Future = Future()
+
+        def resolve(done: Future) -> None:
+            exc = done.exception()
+            if exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(done.result()[start:start + len(rows)])
+
+        batch.add_done_callback(resolve)
+        return fut
+
+    def _write(self, conn: sqlite3.Connection, rows: List[Row], keys: List[Key]) -> Any:
+        # Seqs are stamped onto the messages here, before the future resolves
+        # first: key -> seq of a row written before, or the message of the
+        # first row with that key in this batch
+        first: Dict[bytes, Any] = {}
+        fresh: List[Row] = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for row, key in zip(rows, keys):
+                if key is not None and self.dedup_window:
+                    if key in first:
+                        continue
+                    found = conn.execute("SELECT seq FROM dedup_keys WHERE key = ?", (key,)).fetchone()
+                    if found is not None:
+                        first[key] = found[0]
+                        continue
+                    first[key] = row[0]
+                fresh.append(row)
+            if fresh:
+                conn.execute("UPDATE meta SET value = value + ? WHERE key = 'last_seq'", (len(fresh),))
+                last_seq = conn.execute("SELECT value FROM meta WHERE key = 'last_seq'").fetchone()[0]
+                for seq, (msg, _) in enumerate(fresh, last_seq - len(fresh) + 1):
+                    msg["seq"] = seq
+                now = time.time()
+                conn.executemany(
+                    "INSERT INTO dedup_keys VALUES (?, ?, ?)",
+                    [(key, msg["seq"], now) for key, msg in first.items() if isinstance(msg, dict)],
+                )
+                conn.execute("INSERT INTO segments VALUES (?, ?, ?, ?, ?)", self._segment(fresh))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        results = []
+        for (msg, _), key in zip(rows, keys):
+            seq = first.get(key, msg) if key is not None else msg
+            if seq is msg:
+                results.append((msg["seq"], False))
+            else:
+                results.append((seq if isinstance(seq, int) else seq["seq"], True))
+        return results
+
+    def _prune(self, conn: sqlite3.Connection, now: float) -> None:
+        super()._prune(conn, now)
+        if self.dedup_ttl_s:
+            conn.execute("DELETE FROM dedup_keys WHERE added < ?", (now - self.dedup_ttl_s,))
+        if self.dedup_window:
+            conn.execute(
+                "DELETE FROM dedup_keys WHERE added < "
+                "(SELECT added FROM dedup_keys ORDER BY added DESC LIMIT 1 OFFSET ?)",
+                (self.dedup_window,),
+            )
+
+    def changes(self, after_seq: int) -> List[Row]:
+        # Rows committed by any process with seq > after_seq, in seq order.
+        # Filtering on last_seq (not first_seq) keeps rows that a compaction
+        # has merged into an older segment.
+        if self._reader is None:
+            self._reader = self._connect()
+        version = self._reader.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return []
+        self._data_version = version
+        rows: List[Row] = []
+        for (data,) in self._reader.execute(
+            "SELECT data FROM segments WHERE last_seq > ? ORDER BY first_seq", (after_seq,)
+        ):
+            rows.extend(row for row in pickle.loads(data) if row[0]["seq"] > after_seq)
+        return rows
+
+    def close(self) -> None:
+        super().close()
+        if self._reader is not None:
+            self._reader.close()
+
+
+def open_backend(
+    kind: str,
+    path: str,
+    ttl_s: float = 0.0,
+    synchronous: str = "NORMAL",
+    dedup_window: int = 0,
+    dedup_ttl_s: float = 0.0,
+):
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "sqlite":
+        return SQLiteBackend(path, synchronous=synchronous, ttl_s=ttl_s)
+    if kind == "shared":
+        return SharedSQLiteBackend(
+            path, synchronous=synchronous, ttl_s=ttl_s, dedup_window=dedup_window, dedup_ttl_s=dedup_ttl_s
+        )
+    raise ValueError(f"unknown HUB_STORAGE backend: {kind!r}")
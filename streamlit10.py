@@ -1,11 +1,13 @@
 from datetime import datetime, timezone
 import requests
 import os
-import html as html_lib
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 from streamlit_autorefresh import st_autorefresh
 import streamlit as st
-from streamlit.components.v1 import html as components_html
+from console_client import ConsoleClient, failed_before_sending
+from chat_view import chat_view
+from conversation_buffer import ConversationBuffer
+from send_queue import SendQueue
 
 # ---------------- CONFIG ----------------
 API_BASE = os.environ.get("API_BASE", "http://localhost:8000")
@@ -14,6 +16,13 @@ TENANT_NUMBER = os.environ.get("TENANT_NUMBER", "+16148193454")
 
 REFRESH_INTERVAL_MS = 2000
 SEND_TIMEOUT = 15
+REALTIME_PAGE_LIMIT = 200
+REALTIME_FIELDS = "message,timestamp,ts"
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "32"))
+HTTP_RETRIES = 3
+SEND_WORKERS = 4
+SEND_RETRIES = 3
+SEND_BACKOFF_S = 1.0
 
 st.set_page_config(page_title="Patient Messaging Console", layout="wide")
 
@@ -24,104 +33,94 @@ if "patient_phone" not in st.session_state:
 if "loaded_phone" not in st.session_state:
     st.session_state.loaded_phone = None
 
+# 🔑 Id index + timestamp order, kept across reruns
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = ConversationBuffer()
 
 # 🔑 Used to ignore old realtime messages
 if "session_start_ts" not in st.session_state:
     st.session_state.session_start_ts = datetime.now(timezone.utc)
 
+# 🔑 seq of the last hub message seen; polls only fetch newer ones
+if "hub_cursor" not in st.session_state:
+    st.session_state.hub_cursor = 0
+
+# 🔑 Hub epoch of the cursor: after a hub restart the hub starts it over
+if "hub_epoch" not in st.session_state:
+    st.session_state.hub_epoch = None
+
+if "chat_reset" not in st.session_state:
+    st.session_state.chat_reset = True
+
+# 🔑 Local messages whose send has not completed yet
+if "pending_sends" not in st.session_state:
+    st.session_state.pending_sends = []
+
 if "outgoing_text" not in st.session_state:
     st.session_state.outgoing_text = ""
 
-# ---------------- STYLES ----------------
-BASE_CSS = """
-<style>
-:root { --tenant-bg:#f3f4f6; --patient-bg:#0f172a; }
-.chat-window { height:520px; overflow-y:auto; border:1px solid #e6e6e6; padding:10px; border-radius:10px; }
-.row { display:flex; gap:8px; margin-bottom:6px; }
-.row.patient { justify-content:flex-end; }
-.avatar { width:30px; height:30px; border-radius:50%; display:flex; align-items:center; justify-content:center; font-weight:700; }
-.avatar.tenant { background:#9CA3AF; }
-.avatar.patient { background:#0f172a; color:white; }
-.bubble { padding:8px 10px; border-radius:8px; max-width:72%; }
-.bubble.tenant { background:var(--tenant-bg); }
-.bubble.patient { background:var(--patient-bg); color:white; }
-.empty { text-align:center; color:#9ca3af; padding:28px; }
-</style>
-"""
-
 # ---------------- HELPERS ----------------
-def get_realtime_messages(phone: str) -> List[Dict[str, Any]]:
+# 🔑 One pooled keep-alive client per server process, shared across reruns and tabs
+@st.cache_resource
+def get_client() -> ConsoleClient:
+    return ConsoleClient(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES)
+
+def get_realtime_messages(
+    phone: str, since: int = 0, from_ts: int = 0, epoch: Optional[int] = None
+) -> Tuple[List[Dict[str, Any]], int, Optional[int]]:
+    # 🔑 from_ts (epoch ms): the hub drops older messages, comparing its pre-parsed "ts"
+    params = {
+        "patientPhone": phone,
+        "since": since,
+        "limit": REALTIME_PAGE_LIMIT,
+        "fromTs": from_ts,
+        "fields": REALTIME_FIELDS,
+    }
+    if epoch is not None:
+        params["epoch"] = epoch
     try:
-        resp = requests.get(
-            f"{REALTIME_HUB}/messages/by-phone",
-            params={"patientPhone": phone},
-            timeout=5,
-        )
+        resp = get_client().get("hub.by-phone", f"{REALTIME_HUB}/messages/by-phone", params=params, timeout=5)
         resp.raise_for_status()
-        return resp.json().get("messages", [])
+        body = resp.json()
+        return body.get("messages", []), body.get("nextCursor", since), body.get("epoch", epoch)
     except Exception:
-        return []
+        return [], since, epoch
 
 def send_message_api(from_phone: str, text: str) -> Dict[str, Any]:
     try:
-        resp = requests.post(
+        resp = get_client().post(
+            "api.send",
             f"{API_BASE}/message/send-test-patient-2",
             data={"From": from_phone, "To": TENANT_NUMBER, "Body": text},
             timeout=SEND_TIMEOUT,
         )
         resp.raise_for_status()
         return {"ok": True}
+    except requests.exceptions.ReadTimeout:
+        # 🔑 May already be delivered: never retried
+        return {"ok": False, "error": "Request timed out", "retry": False}
+    except requests.exceptions.HTTPError as e:
+        return {"ok": False, "error": str(e), "retry": e.response.status_code in (502, 503, 504)}
     except Exception as e:
-        return {"ok": False, "error": str(e)}
-
-def normalize_realtime_msg(msg: Dict[str, Any]) -> Dict[str, Any]:
-    ts = msg.get("timestamp") or msg.get("createdAt")
-    if not ts:
-        return {}
-
-    dt = datetime.fromisoformat(ts.replace("Z", "+00:00"))
-
-    # 🔑 IGNORE OLD REALTIME MESSAGES
-    if dt < st.session_state.session_start_ts:
-        return {}
-
-    return {
-        "createdAt": ts,
+        # 🔑 Retried only if the request never left; otherwise it may have been delivered
+        return {"ok": False, "error": str(e), "retry": failed_before_sending(e)}
+
+# 🔑 Sends run on worker threads; later reruns pick up the outcome
+@st.cache_resource
+def get_send_queue() -> SendQueue:
+    return SendQueue(send_message_api, workers=SEND_WORKERS, retries=SEND_RETRIES, backoff=SEND_BACKOFF_S)
+
+def normalize_realtime_msg(msg: Dict[str, Any], hub_epoch: Optional[int]) -> Dict[str, Any]:
+    # 🔑 No parsing here: the hub sends the message time as "ts" (epoch ms)
+    normalized = {
+        "id": f"hub-{hub_epoch}-{msg.get('seq')}",
+        "createdAt": msg.get("timestamp") or msg.get("createdAt") or msg.get("receivedAt"),
         "chatType": "tenant",
         "message": msg.get("message") or msg.get("body") or "",
     }
-
-def render_chat(messages: List[Dict[str, Any]]):
-    rows = []
-    for m in messages:
-        role = m["chatType"]
-        bubble = html_lib.escape(m["message"])
-        rows.append(
-            f"""
-            <div class="row {role}">
-                {'' if role == 'patient' else '<div class="avatar tenant">T</div>'}
-                <div class="bubble {role}">{bubble}</div>
-                {'' if role == 'tenant' else '<div class="avatar patient">P</div>'}
-            </div>
-            """
-        )
-
-    inner = "\n".join(rows) if rows else '<div class="empty">No messages</div>'
-
-    components_html(
-        f"""
-        <html>
-        <head>{BASE_CSS}</head>
-        <body>
-            <div class="chat-window">{inner}</div>
-        </body>
-        </html>
-        """,
-        height=560,
-        scrolling=True,
-    )
+    if "ts" in msg:
+        normalized["epoch"] = msg["ts"] / 1000
+    return normalized
 
 # ---------------- UI ----------------
 st.title("💬 Patient Messaging Console")
@@ -133,7 +132,9 @@ phone = st.text_input("Patient phone number", placeholder="+16144683607")
 if phone and phone != st.session_state.loaded_phone:
     st.session_state.loaded_phone = phone
     st.session_state.patient_phone = phone
-    st.session_state.messages = []
+    st.session_state.messages = ConversationBuffer()
+    st.session_state.hub_cursor = 0
+    st.session_state.chat_reset = True
     st.session_state.session_start_ts = datetime.now(timezone.utc)
 
 if not st.session_state.loaded_phone:
@@ -141,34 +142,65 @@ if not st.session_state.loaded_phone:
     st.stop()
 
 # ---------------- REALTIME ----------------
-realtime = get_realtime_messages(st.session_state.patient_phone)
+# 🔑 IGNORE OLD REALTIME MESSAGES (filtered by the hub)
+realtime, st.session_state.hub_cursor, st.session_state.hub_epoch = get_realtime_messages(
+    st.session_state.patient_phone,
+    st.session_state.hub_cursor,
+    int(st.session_state.session_start_ts.timestamp() * 1000),
+    st.session_state.hub_epoch,
+)
 
-existing = {(m["createdAt"], m["message"]) for m in st.session_state.messages}
+conversation = st.session_state.messages
 
+# 🔑 Only unseen messages are normalized; merging costs O(new messages)
 for msg in realtime:
-    normalized = normalize_realtime_msg(msg)
-    if not normalized:
+    if f"hub-{st.session_state.hub_epoch}-{msg.get('seq')}" in conversation:
         continue
+    conversation.upsert(normalize_realtime_msg(msg, st.session_state.hub_epoch))
 
-    key = (normalized["createdAt"], normalized["message"])
-    if key not in existing:
-        st.session_state.messages.append(normalized)
+# ---------------- SEND OUTCOMES ----------------
+if st.session_state.pending_sends:
+    outcomes = get_send_queue().collect(st.session_state.pending_sends)
+    for local_id, result in outcomes.items():
+        conversation.update(local_id, status="sent" if result["ok"] else "failed")
+        if not result["ok"]:
+            st.error(f"Failed to send message: {result['error']}")
+    st.session_state.pending_sends = [i for i in st.session_state.pending_sends if i not in outcomes]
 
-render_chat(st.session_state.messages)
+# 🔑 Rendered after the send form so this run's send is part of the delta
+chat_slot = st.container()
 
 # ---------------- SEND ----------------
 with st.form("send"):
     text = st.text_area("Send as patient", height=80)
     if st.form_submit_button("Send"):
         if text.strip():
-            st.session_state.messages.append(
-                {
-                    "createdAt": datetime.now(timezone.utc).isoformat(),
-                    "chatType": "patient",
-                    "message": text.strip(),
-                }
-            )
-            send_message_api(st.session_state.patient_phone, text.strip())
+            sent = {
+                "id": f"local-{datetime.now(timezone.utc).timestamp()}",
+                "createdAt": datetime.now(timezone.utc).isoformat(),
+                "chatType": "patient",
+                "message": text.strip(),
+                "status": "sending",
+            }
+            conversation.upsert(sent)
+            get_send_queue().submit(sent["id"], st.session_state.patient_phone, text.strip())
+            st.session_state.pending_sends.append(sent["id"])
+
+with chat_slot:
+    chat_view(
+        conversation,
+        conversation.drain_changes(),
+        role_of=lambda m: m["chatType"],
+        reset=st.session_state.chat_reset,
+        height=520,
+    )
+st.session_state.chat_reset = False
+
+# ---------------- CONNECTION STATS ----------------
+timings = get_client().timings.summary()
+if timings:
+    with st.sidebar.expander("Connection stats"):
+        st.table(timings)
 
 # ---------------- AUTO REFRESH ----------------
 st_autorefresh(interval=REFRESH_INTERVAL_MS, key="refresh")
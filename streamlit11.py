@@ -0,0 +1,282 @@
+from datetime import datetime, timezone
+import requests
+import os
+from typing import List, Dict, Any, Optional, Tuple
+from streamlit_autorefresh import st_autorefresh
+import streamlit as st
+from console_client import ConsoleClient, failed_before_sending
+from chat_view import chat_view
+from conversation_buffer import ConversationBuffer
+from send_queue import SendQueue
+
+# Multi-chat dashboard (same building blocks as streamlit9.py): watches many
+# patient conversations at once. Every tick makes ONE request to the hub's
+# /messages/by-phones with a single seq cursor, however many are watched.
+# A newly watched conversation gets its newest messages up to the cursor from
+# /messages/by-phone once; the shared cursor is never moved back for it.
+
+# ---------------- CONFIG ----------------
+API_BASE = os.environ.get("API_BASE", "http://localhost:8000")
+REALTIME_HUB = os.environ.get("REALTIME_HUB", "http://127.0.0.1:9000")
+TENANT_NUMBER = os.environ.get("TENANT_NUMBER", "+16148193454")
+
+REFRESH_INTERVAL_MS = 2000  # 2 seconds
+SEND_TIMEOUT = 15  # seconds for POST / send
+REALTIME_PAGE_LIMIT = 1000  # max messages per poll, across all watched conversations
+REALTIME_MAX_PAGES = 3  # polls per run while the hub reports more; the rest arrive on the next ticks
+BACKLOG_LIMIT = 100  # newest messages loaded for a conversation when it starts being watched
+REALTIME_FIELDS = "message,timestamp,ts"  # messages come back grouped by patientPhone
+MAX_WATCHED = 48  # the hub accepts up to HUB_MAX_PHONES_PER_QUERY per request
+GRID_COLUMNS = 3
+CHAT_HEIGHT = 360
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "32"))  # keep-alive connections per host
+HTTP_RETRIES = 3  # with exponential backoff; sends are only retried if the connection failed
+SEND_WORKERS = 4  # sends in flight at once (per server process)
+SEND_RETRIES = 3  # failed sends are retried after 1s, 2s, 4s
+SEND_BACKOFF_S = 1.0
+
+st.set_page_config(page_title="Patient Messaging Dashboard", layout="wide")
+
+# ---------------- HELPERS & STATE ----------------
+# phone -> ConversationBuffer of every watched conversation
+if "conversations" not in st.session_state:
+    st.session_state.conversations = {}
+
+# phones whose chat view must be sent the whole conversation again
+if "chat_resets" not in st.session_state:
+    st.session_state.chat_resets = set()
+
+# one seq cursor for all watched conversations (hub seqs are global)
+if "hub_cursor" not in st.session_state:
+    st.session_state.hub_cursor = 0
+# the hub epoch the cursor belongs to (seqs start over in a new one)
+if "hub_epoch" not in st.session_state:
+    st.session_state.hub_epoch = None
+
+# new messages per phone since the conversation was last focused
+if "unread" not in st.session_state:
+    st.session_state.unread = {}
+
+# (phone, local message id) of sends that have not completed yet
+if "pending_sends" not in st.session_state:
+    st.session_state.pending_sends = []
+
+# One pooled client per server process, shared by all reruns and browser tabs
+@st.cache_resource
+def get_client() -> ConsoleClient:
+    return ConsoleClient(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES)
+
+def get_realtime_deltas(
+    phones: List[str], since: int = 0, epoch: Optional[int] = None
+) -> Tuple[Dict[str, List[Dict[str, Any]]], int, Optional[int], bool]:
+    # Returns ({phone: messages newer than `since`}, next cursor, hub epoch, more pending);
+    # on failure the cursor is unchanged. After a hub restart (new epoch) the hub starts the cursor over.
+    params = [("patientPhone", p) for p in phones]
+    params += [("since", since), ("limit", REALTIME_PAGE_LIMIT), ("fields", REALTIME_FIELDS)]
+    if epoch is not None:
+        params.append(("epoch", epoch))
+    try:
+        resp = get_client().get("hub.by-phones", f"{REALTIME_HUB}/messages/by-phones", params=params, timeout=5)
+        resp.raise_for_status()
+        body = resp.json()
+        return body.get("conversations", {}), body.get("nextCursor", since), body.get("epoch", epoch), body.get("hasMore", False)
+    except Exception:
+        return {}, since, epoch, False
+
+def get_hub_head() -> Tuple[int, Optional[int]]:
+    # (highest seq the hub has assigned, hub epoch): where a new session's cursor starts
+    try:
+        resp = get_client().get("hub.stats", f"{REALTIME_HUB}/stats", timeout=5)
+        resp.raise_for_status()
+        body = resp.json()
+        return body["store"]["lastSeq"], body.get("epoch")
+    except Exception:
+        return 0, None
+
+def get_backlog(phone: str, before: int, epoch: Optional[int]) -> List[Dict[str, Any]]:
+    # The newest BACKLOG_LIMIT messages of one conversation with seq < before; [] on failure
+    params = {"patientPhone": phone, "before": before, "limit": BACKLOG_LIMIT, "fields": REALTIME_FIELDS}
+    if epoch is not None:
+        params["epoch"] = epoch
+    try:
+        resp = get_client().get("hub.backlog", f"{REALTIME_HUB}/messages/by-phone", params=params, timeout=5)
+        resp.raise_for_status()
+        body = resp.json()
+        if body.get("epoch", epoch) != epoch:
+            return []  # the hub restarted: the next poll starts over and brings them
+        return body.get("messages", [])
+    except Exception:
+        return []
+
+def send_message_api(from_phone: str, text: str) -> Dict[str, Any]:
+    try:
+        resp = get_client().post(
+            "api.send",
+            f"{API_BASE}/message/send-test-patient-2",
+            data={"From": from_phone, "To": TENANT_NUMBER, "Body": text},
+            timeout=SEND_TIMEOUT,
+        )
+        resp.raise_for_status()
+        try:
+            body = resp.json()
+        except Exception:
+            body = {"status_code": resp.status_code}
+        return {"ok": True, "resp": body, "error": None}
+    except requests.exceptions.ReadTimeout:
+        # The API may have taken the message already; sending it again could duplicate it
+        return {"ok": False, "resp": None, "error": "Request timed out", "retry": False}
+    except requests.exceptions.HTTPError as e:
+        return {"ok": False, "resp": None, "error": str(e), "retry": e.response.status_code in (502, 503, 504)}
+    except requests.exceptions.RequestException as e:
+        # Retried only if the request never left; otherwise it may have been delivered
+        return {"ok": False, "resp": None, "error": str(e), "retry": failed_before_sending(e)}
+
+# Sends run on worker threads; outcomes are picked up by later reruns
+@st.cache_resource
+def get_send_queue() -> SendQueue:
+    return SendQueue(send_message_api, workers=SEND_WORKERS, retries=SEND_RETRIES, backoff=SEND_BACKOFF_S)
+
+def is_patient_msg(m: Dict[str, Any]) -> bool:
+    ct = (m.get("chatType") or "").lower()
+    return ct in ("patient", "inbound", "sms", "user", "from_patient", "user_from_patient")
+
+def normalize_realtime_msg(msg: Dict[str, Any], hub_epoch: Optional[int]) -> Dict[str, Any]:
+    ts = msg.get("timestamp") or msg.get("createdAt") or datetime.now(timezone.utc).isoformat()
+    text = msg.get("message") or msg.get("body") or ""
+    from_field = (msg.get("from") or msg.get("source") or "").lower()
+    chat_type = "patient" if ("+" in from_field or "patient" in from_field or msg.get("direction", "").lower().startswith("inbound")) else "tenant"
+    normalized = {"id": f"hub-{hub_epoch}-{msg.get('seq')}", "createdAt": ts, "chatType": chat_type, "message": text}
+    # the hub parses the message time once at ingest ("ts", epoch ms): no ISO parsing per rerun
+    if "ts" in msg:
+        normalized["epoch"] = msg["ts"] / 1000
+    return normalized
+
+def parse_phones(text: str) -> List[str]:
+    # Distinct phones in input order, not capped at MAX_WATCHED
+    phones = []
+    for part in text.replace(",", "\n").splitlines():
+        phone = part.strip()
+        if phone and phone not in phones:
+            phones.append(phone)
+    return phones
+
+# ---------------- UI ----------------
+st.title("📋 Patient Messaging Dashboard")
+st.caption("Watch many patient conversations with a single hub poll")
+
+phones_text = st.sidebar.text_area(
+    "Watched patient phones (one per line)", height=200, placeholder="+16144683607\n+16145550123"
+)
+entered = parse_phones(phones_text)
+phones = entered[:MAX_WATCHED]
+
+# Start / stop watching: only newly added phones get a buffer (and a full chat render)
+conversations: Dict[str, ConversationBuffer] = st.session_state.conversations
+added = [p for p in phones if p not in conversations]
+for phone in added:
+    conversations[phone] = ConversationBuffer()
+    st.session_state.chat_resets.add(phone)
+for phone in [p for p in conversations if p not in phones]:
+    del conversations[phone]
+    st.session_state.unread.pop(phone, None)
+# A new session starts its cursor at the hub's newest message; newly watched
+# conversations get their messages up to the cursor from their own newest
+# page, the shared poll brings everything after it
+if st.session_state.hub_epoch is None and not st.session_state.hub_cursor:
+    st.session_state.hub_cursor, st.session_state.hub_epoch = get_hub_head()
+for phone in added:
+    backlog = get_backlog(phone, st.session_state.hub_cursor + 1, st.session_state.hub_epoch)
+    conversations[phone].merge([normalize_realtime_msg(m, st.session_state.hub_epoch) for m in backlog])
+
+if not phones:
+    st.info("Add patient phone numbers in the sidebar to start watching conversations.")
+    st.stop()
+
+if len(entered) > MAX_WATCHED:
+    st.sidebar.warning(f"Only the first {MAX_WATCHED} phones are watched.")
+
+focused = st.sidebar.radio(
+    "Focus",
+    phones,
+    format_func=lambda p: f"{p}  ({st.session_state.unread[p]} new)" if st.session_state.unread.get(p) else p,
+)
+st.session_state.unread.pop(focused, None)
+
+# ---------------- REALTIME POLLING (one request for all) ----------------
+# Keep fetching while the hub reports more pending, a few pages per run at most
+for _ in range(REALTIME_MAX_PAGES):
+    deltas, st.session_state.hub_cursor, st.session_state.hub_epoch, has_more = get_realtime_deltas(
+        phones, st.session_state.hub_cursor, st.session_state.hub_epoch
+    )
+    hub_epoch = st.session_state.hub_epoch
+    for phone, msgs in deltas.items():
+        conversation = conversations.get(phone)
+        if conversation is None:
+            continue
+        added_count = conversation.merge(
+            [normalize_realtime_msg(m, hub_epoch) for m in msgs if f"hub-{hub_epoch}-{m.get('seq')}" not in conversation]
+        )
+        if added_count and phone != focused and phone not in added:
+            st.session_state.unread[phone] = st.session_state.unread.get(phone, 0) + added_count
+    if not has_more:
+        break
+
+# ---------------- SEND OUTCOMES ----------------
+if st.session_state.pending_sends:
+    outcomes = get_send_queue().collect(tmp_id for _, tmp_id in st.session_state.pending_sends)
+    for phone, tmp_id in st.session_state.pending_sends:
+        result = outcomes.get(tmp_id)
+        if result is None or phone not in conversations:
+            continue
+        conversations[phone].update(tmp_id, status="sent" if result["ok"] else "failed")
+        if not result["ok"]:
+            st.error(f"Failed to send message to {phone}: {result['error']}")
+    st.session_state.pending_sends = [(p, i) for p, i in st.session_state.pending_sends if i not in outcomes]
+
+# ---------------- SEND MESSAGE ----------------
+with st.form("send-message", clear_on_submit=True):
+    outgoing = st.text_area(f"Message to {focused}", height=80, max_chars=1600)
+    if st.form_submit_button("Send"):
+        text = (outgoing or "").strip()
+        if not text:
+            st.warning("Please type a message before sending.")
+        else:
+            tmp_id = f"tmp-{focused}-{datetime.now(timezone.utc).timestamp()}"
+            conversations[focused].upsert({
+                "createdAt": datetime.now(timezone.utc).isoformat(),
+                "chatType": "patient",
+                "message": text,
+                "status": "sending",
+                "id": tmp_id,
+            })
+            get_send_queue().submit(tmp_id, focused, text)
+            st.session_state.pending_sends.append((focused, tmp_id))
+
+# ---------------- CHAT GRID ----------------
+# Every chat view is a mounted component that only receives its own delta
+columns = st.columns(GRID_COLUMNS)
+for index, phone in enumerate(phones):
+    conversation = conversations[phone]
+    with columns[index % GRID_COLUMNS]:
+        label = f"**{phone}**" + (" · focused" if phone == focused else "")
+        if st.session_state.unread.get(phone):
+            label += f" · {st.session_state.unread[phone]} new"
+        st.markdown(label)
+        chat_view(
+            conversation,
+            conversation.drain_changes(),
+            role_of=lambda m: "patient" if is_patient_msg(m) else "tenant",
+            reset=phone in st.session_state.chat_resets,
+            height=CHAT_HEIGHT,
+            key=f"chat-{phone}",
+        )
+st.session_state.chat_resets.clear()
+
+# ---------------- CONNECTION STATS ----------------
+timings = get_client().timings.summary()
+if timings:
+    with st.sidebar.expander("Connection stats"):
+        st.table(timings)
+
+# ---------------- AUTO REFRESH ----------------
+st_autorefresh(interval=REFRESH_INTERVAL_MS, key="dashboard-refresh")
@@ -1,11 +1,14 @@
 from datetime import datetime, timezone
 import requests
 import os
-import html as html_lib
-from typing import List, Dict, Any
+from urllib.parse import urlencode
+from typing import List, Dict, Any, Optional, Tuple
 from streamlit_autorefresh import st_autorefresh
 import streamlit as st
-from streamlit.components.v1 import html as components_html
+from console_client import ConsoleClient, failed_before_sending
+from chat_view import chat_view, older_requested
+from conversation_buffer import ConversationBuffer, parse_time
+from send_queue import SendQueue
 
 # ---------------- CONFIG ----------------
 API_BASE = os.environ.get("API_BASE", "http://localhost:8000")
@@ -14,66 +17,29 @@ TENANT_NUMBER = os.environ.get("TENANT_NUMBER", "+16148193454")
 
 REFRESH_INTERVAL_MS = 2000  # 2 seconds
 SEND_TIMEOUT = 15  # seconds for POST / send
-# LOAD_TIMEOUT = 20
+REALTIME_PAGE_LIMIT = 200  # max messages per poll; the rest arrive on the next ticks
+REALTIME_FIELDS = "message,timestamp,ts"  # all normalize_realtime_msg reads from a hub message (seq is always sent)
+# "poll": rerun the script every REFRESH_INTERVAL_MS and fetch deltas.
+# "stream": the chat component subscribes to the hub's event stream and appends
+# messages as they arrive; the script only reruns on user interaction. The hub
+# must list this console's origin in HUB_CORS_ORIGINS.
+REALTIME_MODE = os.environ.get("REALTIME_MODE", "poll")
+# Hub URL as seen from the browser (the stream is opened by the iframe, not by Python)
+REALTIME_HUB_PUBLIC = os.environ.get("REALTIME_HUB_PUBLIC", REALTIME_HUB)
+LOAD_TIMEOUT = 20  # seconds for a history page
+HISTORY_PAGE_SIZE = 50  # history messages per page, newest first
+HISTORY_CACHE_TTL_S = 300  # cached history pages are refetched after this
+HISTORY_CACHE_MAX_ENTRIES = 500  # cached history pages, across all patients (per server process)
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "32"))  # keep-alive connections per host
+HTTP_RETRIES = 3  # with exponential backoff; sends are only retried if the connection failed
+SEND_WORKERS = 4  # sends in flight at once (per server process)
+SEND_RETRIES = 3  # failed sends are retried after 1s, 2s, 4s
+SEND_BACKOFF_S = 1.0
+SEND_STATUS_REFRESH_MS = 1000  # reruns while a send is pending, to pick up its outcome
+CONTENT_KEYS_MAX = 5000  # (second, text) keys remembered per source to match history and hub copies
 
 st.set_page_config(page_title="Patient Messaging Console", layout="wide")
 
-# ---------------- COMPACT STYLES ----------------
-BASE_CSS = """
-<style>
-:root { --bg: #ffffff; --muted: #6b7280; --tenant-bg:#f3f4f6; --patient-bg:#0f172a; }
-body { font-family: Inter, system-ui, -apple-system, "Segoe UI", Roboto, "Helvetica Neue", Arial; }
-.container { max-width: 980px; margin: 10px auto; }
-.header { display:flex; justify-content:space-between; align-items:center; gap:12px; margin-bottom:8px; }
-.title { font-size:18px; font-weight:700; color:#111827; }
-.note { color:var(--muted); font-size:12px; }
-.chat-window {
-  background: var(--bg);
-  border-radius: 10px;
-  padding: 10px;
-  height: 520px;
-  overflow-y: auto;
-  border: 1px solid #e6e6e6;
-  box-shadow: 0 1px 2px rgba(0,0,0,0.04);
-}
-.row { display:flex; gap:8px; margin-bottom:6px; align-items:flex-end; }
-.row.patient { justify-content:flex-end; }
-.avatar { width:30px; height:30px; border-radius:50%; display:inline-flex; align-items:center; justify-content:center; font-weight:700; color:#fff; font-size:12px; flex: 0 0 30px; }
-.avatar.tenant { background:#9CA3AF; color:#111827; }
-.avatar.patient { background:#111827; }
-.bubble {
-  padding:8px 10px;
-  border-radius:8px;
-  max-width:72%;
-  font-size:13px;
-  line-height:1.25;
-  word-break:break-word;
-  white-space:pre-wrap;
-}
-.bubble.tenant { background:var(--tenant-bg); color:#111827; border-bottom-left-radius:4px; }
-.bubble.patient { background:var(--patient-bg); color:#fff; border-bottom-right-radius:4px; }
-.meta { font-size:11px; color:var(--muted); margin-top:4px; display:flex; gap:8px; align-items:center; }
-.status-dot { width:8px; height:8px; border-radius:50%; display:inline-block; }
-.status-sending { background:#f59e0b; }
-.status-sent { background:#10b981; }
-.status-failed { background:#ef4444; }
-.empty { text-align:center; color:#9ca3af; padding:28px 0; }
-.footer { margin-top:8px; display:flex; gap:8px; align-items:center; }
-.input { flex:1; }
-.send-btn { background:#0f172a; color:white; border:none; padding:8px 12px; border-radius:8px; cursor:pointer; }
-.small { font-size:12px; color:var(--muted); }
-.placeholder-card {
-  max-width: 980px;
-  margin: 24px auto;
-  padding: 28px;
-  border-radius: 12px;
-  border: 1px dashed #e5e7eb;
-  color: #6b7280;
-  text-align: center;
-}
-</style>
-"""
-
 # ---------------- HELPERS & STATE ----------------
 if "patient_phone" not in st.session_state:
     st.session_state.patient_phone = ""
@@ -81,36 +47,84 @@ if "patient_phone" not in st.session_state:
 if "loaded_phone" not in st.session_state:
     st.session_state.loaded_phone = None
 
+# messages of the loaded conversation: id index + sorted by timestamp, kept across reruns
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = ConversationBuffer()
 
 if "session_start_ts" not in st.session_state:
     st.session_state.session_start_ts = datetime.now(timezone.utc)
+
+# History paging: createdAt of the oldest history message loaded (None: nothing
+# loaded yet), and whether the API has older ones
+if "history_before" not in st.session_state:
+    st.session_state.history_before = None
+if "history_more" not in st.session_state:
+    st.session_state.history_more = False
+# (second, text) of the history and of the hub messages shown: a message is
+# dropped only if the *other* source already delivered it, so two identical
+# messages in the same second from one source are both kept
+if "history_keys" not in st.session_state:
+    st.session_state.history_keys = set()
+if "hub_keys" not in st.session_state:
+    st.session_state.hub_keys = set()
+
+# seq of the last hub message we have seen; polls only ask for newer ones
+if "hub_cursor" not in st.session_state:
+    st.session_state.hub_cursor = 0
+# the hub epoch the cursor belongs to (seqs start over in a new one)
+if "hub_epoch" not in st.session_state:
+    st.session_state.hub_epoch = None
+# set when the chat view must be sent the whole conversation again
+if "chat_reset" not in st.session_state:
+    st.session_state.chat_reset = True
+# ids of local messages whose send has not completed yet
+if "pending_sends" not in st.session_state:
+    st.session_state.pending_sends = []
 # ensure outgoing_text exists before any widget uses that key
 if "outgoing_text" not in st.session_state:
     st.session_state.outgoing_text = ""
 
-@st.cache_data(show_spinner=False)
-def load_past_messages(phone: str) -> List[Dict[str, Any]]:
+# One pooled client per server process, shared by all reruns and browser tabs
+@st.cache_resource
+def get_client() -> ConsoleClient:
+    return ConsoleClient(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES)
+
+# One page of history: the newest HISTORY_PAGE_SIZE chats created before
+# `before` (None: the newest ones), and whether older ones remain. Pages are
+# cached per (phone, before), with a TTL and a bound on the number of pages.
+# Errors raise, so that failures are not cached.
+@st.cache_data(show_spinner=False, ttl=HISTORY_CACHE_TTL_S, max_entries=HISTORY_CACHE_MAX_ENTRIES)
+def load_past_messages(phone: str, before: Optional[str] = None) -> Tuple[List[Dict[str, Any]], bool]:
+    params = {"patientPhone": phone, "limit": HISTORY_PAGE_SIZE}
+    if before:
+        params["before"] = before
+    resp = get_client().get("api.history", f"{API_BASE}/chat/by-phone", params=params, timeout=LOAD_TIMEOUT)
+    resp.raise_for_status()
+    body = resp.json()
+    chats = body.get("chats", [])
+    if len(chats) > HISTORY_PAGE_SIZE:
+        # The API ignored the paging parameters: this is the whole history
+        return chats, False
+    return chats, body.get("hasMore", len(chats) == HISTORY_PAGE_SIZE)
+
+def get_realtime_messages(phone: str, since: int = 0, epoch: Optional[int] = None) -> Tuple[List[Dict[str, Any]], int, Optional[int]]:
+    # Returns (messages newer than `since`, next cursor, hub epoch); on failure the cursor is unchanged.
+    # After a hub restart (new epoch) the hub ignores the old cursor and starts over.
+    params = {"patientPhone": phone, "since": since, "limit": REALTIME_PAGE_LIMIT, "fields": REALTIME_FIELDS}
+    if epoch is not None:
+        params["epoch"] = epoch
     try:
-        resp = requests.get(f"{API_BASE}/chat/by-phone", params={"patientPhone": phone}, timeout=LOAD_TIMEOUT)
+        resp = get_client().get("hub.by-phone", f"{REALTIME_HUB}/messages/by-phone", params=params, timeout=5)
         resp.raise_for_status()
-        return resp.json().get("chats", [])
+        body = resp.json()
+        return body.get("messages", []), body.get("nextCursor", since), body.get("epoch", epoch)
     except Exception:
-        # On failure return empty list (calling code may show UI feedback)
-        return []
-
-def get_realtime_messages(phone: str) -> List[Dict[str, Any]]:
-    try:
-        resp = requests.get(f"{REALTIME_HUB}/messages/by-phone", params={"patientPhone": phone}, timeout=5)
-        resp.raise_for_status()
-        return resp.json().get("messages", [])
-    except Exception:
-        return []
+        return [], since, epoch
 
 def send_message_api(from_phone: str, text: str) -> Dict[str, Any]:
     try:
-        resp = requests.post(
+        resp = get_client().post(
+            "api.send",
             f"{API_BASE}/message/send-test-patient-2",
             data={"From": from_phone, "To": TENANT_NUMBER, "Body": text},
             timeout=SEND_TIMEOUT,
@@ -122,121 +136,66 @@ def send_message_api(from_phone: str, text: str) -> Dict[str, Any]:
             body = {"status_code": resp.status_code}
         return {"ok": True, "resp": body, "error": None}
     except requests.exceptions.ReadTimeout:
-        return {"ok": False, "resp": None, "error": "Request timed out"}
+        # The API may have taken the message already; sending it again could duplicate it
+        return {"ok": False, "resp": None, "error": "Request timed out", "retry": False}
+    except requests.exceptions.HTTPError as e:
+        return {"ok": False, "resp": None, "error": str(e), "retry": e.response.status_code in (502, 503, 504)}
     except requests.exceptions.RequestException as e:
-        return {"ok": False, "resp": None, "error": str(e)}
+        # Retried only if the request never left; otherwise it may have been delivered
+        return {"ok": False, "resp": None, "error": str(e), "retry": failed_before_sending(e)}
+
+# Sends run on worker threads; outcomes are picked up by later reruns
+@st.cache_resource
+def get_send_queue() -> SendQueue:
+    return SendQueue(send_message_api, workers=SEND_WORKERS, retries=SEND_RETRIES, backoff=SEND_BACKOFF_S)
 
 def is_patient_msg(m: Dict[str, Any]) -> bool:
     ct = (m.get("chatType") or "").lower()
     return ct in ("patient", "inbound", "sms", "user", "from_patient", "user_from_patient")
 
-def normalize_realtime_msg(msg: Dict[str, Any]) -> Dict[str, Any]:
+def normalize_history_msg(chat: Dict[str, Any]) -> Dict[str, Any]:
+    ts = chat.get("createdAt") or chat.get("timestamp") or ""
+    text = chat.get("message") or chat.get("body") or ""
+    chat_id = chat.get("id") or chat.get("_id") or f"{ts}-{hash(text)}"
+    return {"id": f"api-{chat_id}", "createdAt": ts, "chatType": chat.get("chatType") or "", "message": text, "epoch": parse_time(ts)}
+
+def content_key(msg: Dict[str, Any]) -> Tuple[int, str]:
+    epoch = msg["epoch"] if "epoch" in msg else parse_time(msg.get("createdAt"))
+    return int(epoch), msg["message"]
+
+def remember_keys(keys: set, msgs: List[Dict[str, Any]]) -> None:
+    # Only the first CONTENT_KEYS_MAX are kept: the newest history pages and
+    # the oldest hub messages, which is where the two sources overlap
+    for m in msgs:
+        if len(keys) >= CONTENT_KEYS_MAX:
+            break
+        keys.add(content_key(m))
+
+def load_history_page(conversation: ConversationBuffer) -> None:
+    # Merges the next older page of history into the conversation
+    try:
+        chats, more = load_past_messages(st.session_state.patient_phone, st.session_state.history_before)
+    except Exception as e:
+        st.warning(f"Could not load the conversation history: {e}")
+        return
+    page = [normalize_history_msg(c) for c in chats]
+    hub_keys = st.session_state.hub_keys
+    conversation.merge([m for m in page if content_key(m) not in hub_keys])
+    remember_keys(st.session_state.history_keys, page)
+    if page:
+        st.session_state.history_before = min(page, key=lambda m: m["epoch"])["createdAt"]
+    st.session_state.history_more = more and bool(page)
+
+def normalize_realtime_msg(msg: Dict[str, Any], hub_epoch: Optional[int]) -> Dict[str, Any]:
     ts = msg.get("timestamp") or msg.get("createdAt") or datetime.now(timezone.utc).isoformat()
     text = msg.get("message") or msg.get("body") or ""
     from_field = (msg.get("from") or msg.get("source") or "").lower()
     chat_type = "patient" if ("+" in from_field or "patient" in from_field or msg.get("direction", "").lower().startswith("inbound")) else "tenant"
-    return {"createdAt": ts, "chatType": chat_type, "message": text}
-
-def format_time(ts: str) -> str:
-    try:
-        dt = datetime.fromisoformat(ts.replace("Z", "+00:00"))
-        return dt.strftime("%b %d • %H:%M")
-    except Exception:
-        return ts
-
-def render_chat_iframe(messages: List[Dict[str, Any]], iframe_height: int = 520):
-    rows = []
-    for msg in sorted(messages, key=lambda x: x.get("createdAt", "")):
-        print("All Messages",msg)
-        patient = is_patient_msg(msg)
-        role = "patient" if patient else "tenant"
-        msg_text = html_lib.escape(msg.get("message", "") or "")
-        timestamp = format_time(str(msg.get("createdAt", "") or ""))
-        status = msg.get("status", "")
-        status_dot = ""
-        if status:
-            cls = "status-sending" if status == "sending" else "status-sent" if status == "sent" else "status-failed"
-            status_dot = f'<span class="status-dot {cls}" title="{status}"></span>'
-        left_avatar = f"<div class='avatar tenant'>T</div>" if not patient else ""
-        right_avatar = f"<div class='avatar patient'>P</div>" if patient else ""
-        bubble = f"""
-        <div class="row {role}">
-          {left_avatar}
-          <div>
-            <div class="bubble {role}">{msg_text}</div>
-            <div class="meta"><span class="small">{timestamp}</span> {status_dot}</div>
-          </div>
-          {right_avatar}
-        </div>
-        """
-        rows.append(bubble)
-
-    inner = "\n".join(rows) if rows else '<div class="empty">No messages yet — start the conversation</div>'
-
-    # Add a script that reliably scrolls the chat-window to bottom on load and whenever content changes.
-    # The MutationObserver ensures auto-scroll for new messages appended after the iframe has loaded.
-    full = f"""
-    <!doctype html>
-    <html>
-    <head>
-      <meta charset="utf-8" />
-      {BASE_CSS}
-    </head>
-    <body>
-      <div class="container">
-        <div class="header">
-          <div class="title">Patient Messaging</div>
-        </div>
-        <div id="chat-window" class="chat-window">
-          {inner}
-        </div>
-      </div>
-
-      <script>
-        (function() {{
-          var chat = document.getElementById('chat-window');
-
-          function scrollToBottom() {{
-            try {{
-              if (chat) {{
-                chat.scrollTop = chat.scrollHeight;
-              }}
-            }} catch (e) {{ /* ignore */ }}
-          }}
-
-          // Scroll after a short delay on load to let layout settle
-          window.addEventListener('load', function() {{
-            setTimeout(scrollToBottom, 30);
-            setTimeout(scrollToBottom, 150); // a second attempt in case images/fonts change layout
-          }});
-
-          // Also run on DOMContentLoaded (some environments fire this instead of load)
-          document.addEventListener('DOMContentLoaded', function() {{
-            setTimeout(scrollToBottom, 20);
-          }});
-
-          // MutationObserver: whenever children/characterData change, scroll to bottom.
-          if (window.MutationObserver && chat) {{
-            var mo = new MutationObserver(function(muts) {{
-              // small timeout to allow rendering
-              setTimeout(scrollToBottom, 20);
-            }});
-            mo.observe(chat, {{ childList: true, subtree: true, characterData: true }});
-          }}
-
-          // Expose a simple message-based trigger: parent can postMessage('scroll-to-bottom')
-          window.addEventListener('message', function(ev) {{
-            if (ev && ev.data === 'scroll-to-bottom') {{
-              setTimeout(scrollToBottom, 10);
-            }}
-          }});
-        }})();
-      </script>
-    </body>
-    </html>
-    """
-    # Allow the iframe itself to scroll (scrolling=True). The iframe's internal script scrolls the chat-window automatically.
-    components_html(full, height=iframe_height, scrolling=True)
+    normalized = {"id": f"hub-{hub_epoch}-{msg.get('seq')}", "createdAt": ts, "chatType": chat_type, "message": text}
+    # the hub parses the message time once at ingest ("ts", epoch ms): no ISO parsing per rerun
+    if "ts" in msg:
+        normalized["epoch"] = msg["ts"] / 1000
+    return normalized
 
 # ---------------- UI ----------------
 st.title("💬 Patient Messaging Console")
@@ -248,29 +207,63 @@ phone = st.text_input("Patient phone number", placeholder="+16144683607", value=
 # Load past messages only when a phone number is provided and it's different from what's loaded
 if phone and phone != st.session_state.loaded_phone:
     with st.spinner("Loading conversation…"):
-        # st.session_state.messages = []
         st.session_state.loaded_phone = phone
         st.session_state.patient_phone = phone
-        st.session_state.messages = []
+        st.session_state.messages = ConversationBuffer()
+        st.session_state.hub_cursor = 0
+        st.session_state.chat_reset = True
         st.session_state.session_start_ts = datetime.now(timezone.utc)
+        st.session_state.history_keys = set()
+        st.session_state.hub_keys = set()
+        st.session_state.history_before = None
+        st.session_state.history_more = False
+        # Only the newest page now; older pages are loaded on demand
+        load_history_page(st.session_state.messages)
 
 # If no phone has been loaded yet, show a simple placeholder and skip rendering chat + send form
 if not st.session_state.loaded_phone:
     st.markdown(f"<div class='placeholder-card'>Enter a patient phone number above to load the conversation.</div>", unsafe_allow_html=True)
 else:
     # ---------------- REALTIME POLLING ----------------
-    realtime = get_realtime_messages(st.session_state.patient_phone)
-    existing = {(m.get("createdAt"), (m.get("message") or "").strip()) for m in st.session_state.messages}
-    for msg in realtime:
-        normalized = normalize_realtime_msg(msg)
-        key = (normalized.get("createdAt"), (normalized.get("message") or "").strip())
-        if key not in existing:
-            st.session_state.messages.append(normalized)
+    realtime, st.session_state.hub_cursor, st.session_state.hub_epoch = get_realtime_messages(
+        st.session_state.patient_phone, st.session_state.hub_cursor, st.session_state.hub_epoch
+    )
+    # Only messages not seen yet are normalized; merging costs O(new messages)
+    conversation = st.session_state.messages
+    hub_epoch = st.session_state.hub_epoch
+    fresh = [
+        normalize_realtime_msg(m, hub_epoch) for m in realtime if f"hub-{hub_epoch}-{m.get('seq')}" not in conversation
+    ]
+    history_keys = st.session_state.history_keys
+    conversation.merge([m for m in fresh if content_key(m) not in history_keys])
+    remember_keys(st.session_state.hub_keys, fresh)
+
+    # ---------------- HISTORY ----------------
+    # Older pages: on scrolling to the top of the chat, or with the button
+    load_older = st.button("Load older messages", disabled=not st.session_state.history_more)
+    if st.session_state.history_more and (older_requested() or load_older):
+        load_history_page(conversation)
+
+    # ---------------- SEND OUTCOMES ----------------
+    if st.session_state.pending_sends:
+        outcomes = get_send_queue().collect(st.session_state.pending_sends)
+        for tmp_id, result in outcomes.items():
+            if result["ok"]:
+                server_ts = None
+                if isinstance(result["resp"], dict):
+                    server_ts = result["resp"].get("timestamp") or result["resp"].get("createdAt") or result["resp"].get("sentAt")
+                if server_ts:
+                    conversation.update(tmp_id, status="sent", createdAt=server_ts)
+                else:
+                    conversation.update(tmp_id, status="sent")
+            else:
+                conversation.update(tmp_id, status="failed")
+                st.error(f"Failed to send message: {result['error']}")
+        st.session_state.pending_sends = [i for i in st.session_state.pending_sends if i not in outcomes]
 
     # ---------------- CHAT VIEW ----------------
-    num_messages = len(st.session_state.messages)
-    iframe_height = min(700, max(360, 240 + num_messages * 26))
-    render_chat_iframe(st.session_state.messages, iframe_height=iframe_height)
+    # Filled in after the send form, so a message sent in this run is already in the delta
+    chat_slot = st.container()
 
     # ---------------- SEND MESSAGE ----------------
     st.markdown("---")
@@ -285,7 +278,7 @@ else:
             elif not st.session_state.patient_phone:
                 st.warning("Please enter a patient phone number first.")
             else:
-                # Add local 'sending' message to show immediately
+                # Add local 'sending' message to show immediately; the send runs in the background
                 tmp_id = f"tmp-{len(st.session_state.messages)+1}-{datetime.now(timezone.utc).timestamp()}"
                 tmp_msg = {
                     "createdAt": datetime.now(timezone.utc).isoformat(),
@@ -294,44 +287,38 @@ else:
                     "status": "sending",
                     "id": tmp_id,
                 }
-                st.session_state.messages.append(tmp_msg)
+                conversation.upsert(tmp_msg)
+                get_send_queue().submit(tmp_id, st.session_state.patient_phone, text)
+                st.session_state.pending_sends.append(tmp_id)
 
-                # Call API and update status
-                result = send_message_api(st.session_state.patient_phone, text)
-                if result["ok"]:
-                    for m in reversed(st.session_state.messages):
-                        if m.get("id") == tmp_id:
-                            m["status"] = "sent"
-                            server_ts = None
-                            if isinstance(result["resp"], dict):
-                                server_ts = result["resp"].get("timestamp") or result["resp"].get("createdAt") or result["resp"].get("sentAt")
-                            if server_ts:
-                                m["createdAt"] = server_ts
-                            break
-                else:
-                    for m in reversed(st.session_state.messages):
-                        if m.get("id") == tmp_id:
-                            m["status"] = "failed"
-                            break
-                    st.error(f"Failed to send message: {result['error']}")
+    num_messages = len(conversation)
+    iframe_height = min(700, max(360, 240 + num_messages * 26))
+    stream_url = None
+    if REALTIME_MODE == "stream":
+        stream_url = f"{REALTIME_HUB_PUBLIC}/messages/stream?" + urlencode({"patientPhone": st.session_state.patient_phone})
+    with chat_slot:
+        chat_view(
+            conversation,
+            conversation.drain_changes(),
+            role_of=lambda m: "patient" if is_patient_msg(m) else "tenant",
+            reset=st.session_state.chat_reset,
+            height=iframe_height,
+            stream_url=stream_url,
+            has_older=st.session_state.history_more,
+        )
+    st.session_state.chat_reset = False
 
-                # Nudge iframe to re-scroll (posting a message that iframe listens to)
-                st.markdown(
-                    """
-                    <script>
-                    (function() {
-                      try {
-                        var iframes = window.document.querySelectorAll('iframe');
-                        iframes.forEach(function(f) {
-                          try { f.contentWindow.postMessage('scroll-to-bottom', '*'); } catch(e) {}
-                        });
-                      } catch(e) {}
-                    })();
-                    </script>
-                    """,
-                    unsafe_allow_html=True,
-                )
+# ---------------- CONNECTION STATS ----------------
+timings = get_client().timings.summary()
+if timings:
+    with st.sidebar.expander("Connection stats"):
+        st.table(timings)
 
 # ---------------- AUTO REFRESH ----------------
+# In stream mode the iframe receives new messages itself, so timed reruns are
+# only needed to pick up the outcome of pending sends
 if st.session_state.loaded_phone:
-    st_autorefresh(interval=REFRESH_INTERVAL_MS, key="chat-refresh")
\ No newline at end of file
+    if REALTIME_MODE != "stream":
+        st_autorefresh(interval=REFRESH_INTERVAL_MS, key="chat-refresh")
+    elif st.session_state.pending_sends:
+        st_autorefresh(interval=SEND_STATUS_REFRESH_MS, key="chat-refresh")
\ No newline at end of file